@@ -0,0 +1,180 @@
+import uasyncio as asyncio
+import ujson
+
+from micropython import const
+from dispatch import Dispatcher
+from pkg import uid_key
+import ingest
+
+# history queries waiting for check_api, one per sensor
+HISTORY_PENDING = const(8)
+# batch results waiting for check_api
+BATCH_PENDING = const(8)
+
+
+class App:
+    # The MQTT side of a master device: command handlers, state publishing and the offline spool.
+    # It only needs an MQTT client with is_connected, publish() and subscribe(), so main.py runs
+    # it on the device and host/fleet.py runs many of them against a local broker.
+    def __init__(self, master, telemetry=None, spool=None, lora=None):
+        self.master = master
+        self.telemetry = telemetry
+        # telemetry published while offline, sent again after reconnect
+        self.spool = spool
+        # radio whose counters (Lora.stats) go to '<uuid>/stats' with every periodic publish, see stats()
+        self.lora = lora
+        # history queries and batch results waiting for check_api
+        self.history_req = []
+        self.batch_res = []
+        self.reboot_req = False
+        # topic -> handler table, built on the first connection
+        self.routes = None
+
+#==========================COMMANDS==========================
+
+    def on_time(self, topic: str, payload: bytes):
+        self.master.sync_time(int(payload.decode('utf8')))
+
+    def on_req(self, topic: str, payload: bytes):
+        if payload == b'true':
+            self.master.req = True
+        elif payload == b'reboot':
+            self.reboot_req = True
+
+    def on_api_req(self, topic: str, payload: bytes):
+        if topic.endswith('/req') and payload == b'reboot':
+            self.reboot_req = True
+
+    def on_ack(self, topic: str, payload: bytes):
+        self.telemetry.ack(int(payload.decode('utf8')))
+
+    def on_updated(self, topic: str, payload: bytes):
+        payload = ingest.command(payload, ingest.UPDATE)
+        self.master.update(payload)
+
+    def on_add_wireless_sensor(self, topic: str, payload: bytes):
+        payload = ingest.command(payload, ingest.ADD_WIRELESS_SENSOR)
+        self.master.add_lora(payload.get("name"), payload.get("uid"))
+
+    def on_remove_wireless_sensor(self, topic: str, payload: bytes):
+        payload = ingest.command(payload, ingest.REMOVE_WIRELESS_SENSOR)
+        self.master.delete_lora(payload.get("uid"))
+
+    def on_history(self, topic: str, payload: bytes):
+        payload = ingest.command(payload, ingest.HISTORY)
+        key = uid_key(payload["uid"])
+        for i, query in enumerate(self.history_req):
+            if uid_key(query["uid"]) == key:
+                # a newer query for the same sensor replaces the one not answered yet
+                self.history_req[i] = payload
+                return
+        if len(self.history_req) >= HISTORY_PENDING:
+            raise ValueError('too many history queries')
+        self.history_req.append(payload)
+
+    def on_batch(self, topic: str, payload: bytes):
+        payload = ingest.command(payload, ingest.BATCH)
+        if len(self.batch_res) >= BATCH_PENDING:
+            # refused before anything is applied, a batch never goes without its result
+            raise ValueError('too many batch results')
+        result = {"id": payload.get("id"), "ok": True, "applied": len(payload["ops"])}
+        try:
+            self.master.batch(payload["ops"])
+        except Exception as e:
+            # a failed check or an operation that failed and was rolled back
+            result["ok"] = False
+            result["applied"] = 0
+            result["error"] = str(e)
+        self.batch_res.append(result)
+
+    def build_routes(self, prefix: str) -> Dispatcher:
+        # topic strings are formatted once here, the subscriptions are taken from the same table
+        uuid = self.master.uuid
+        routes = Dispatcher()
+        routes.add(prefix + '/api/+/req/#', self.on_api_req)
+        routes.add('service/time/utc', self.on_time)
+        routes.add(f'FF09/{uuid}/req', self.on_req)
+        routes.add(f'FF09/{uuid}/updated', self.on_updated)
+        routes.add(f'FF09/{uuid}/add-wireless-sensor', self.on_add_wireless_sensor)
+        routes.add(f'FF09/{uuid}/remove-wireless-sensor', self.on_remove_wireless_sensor)
+        routes.add(f'FF09/{uuid}/history', self.on_history)
+        routes.add(f'FF09/{uuid}/batch', self.on_batch)
+        if self.telemetry != None:
+            routes.add(f'FF09/{uuid}/ack', self.on_ack)
+        return routes
+
+    def subscribe(self, mqtt, prefix: str):
+        if self.routes == None:
+            self.routes = self.build_routes(prefix)
+        for topic in self.routes.topics():
+            mqtt.subscribe(topic=topic)
+
+    def dispatch(self, topic: str, payload: bytes):
+        if self.routes != None:
+            self.routes.dispatch(topic, payload)
+
+#==========================PUBLISH==========================
+
+    def send(self, mqtt, topic: str, payload):
+        # until the spool is drained new messages queue behind it, the backend gets them in order
+        spool = self.spool
+        if mqtt.is_connected and (spool == None or spool.empty):
+            mqtt.publish(topic=topic, payload=payload, retain=False)
+        elif spool != None:
+            spool.put(topic, payload)
+
+    def publish_state(self, mqtt):
+        master = self.master
+        if self.telemetry != None:
+            self.send(mqtt, f'{master.uuid}/delta', self.telemetry.next())
+        else:
+            self.send(mqtt, master.uuid, master.convert_to_pkg())
+
+    def stats(self):
+        # counters of the store, the spool, the command routes and the radio, those present
+        stats = {"store": self.master.store.stats()}
+        if self.spool != None:
+            stats["spool"] = self.spool.stats()
+        if self.routes != None:
+            stats["mqtt"] = self.routes.stats()
+        if self.lora != None:
+            stats["lora"] = self.lora.stats()
+        return stats
+
+    def publish_stats(self, mqtt):
+        self.send(mqtt, f'{self.master.uuid}/stats', ujson.dumps(self.stats()))
+
+    def lora_packet(self, mqtt, uid: int, hum, bat, rssi):
+        self.master.lora_data(uid, hum, bat, rssi)
+        self.spool_sample(mqtt, uid, hum, bat, rssi)
+
+    def spool_sample(self, mqtt, uid: int, hum, bat, rssi):
+        if not mqtt.is_connected and self.spool != None:
+            # the live state only carries the last reading, offline samples are kept one by one
+            master = self.master
+            self.spool.put(f'{master.uuid}/sample', ujson.dumps(
+                {"uid": f'{uid:08x}', "humidity": hum, "batteryLevel": bat, "rssi": rssi, "ts": master.now()}))
+
+    async def publish_pkg(self, mqtt, period_s):
+        while True:
+            self.publish_state(mqtt)
+            self.publish_stats(mqtt)
+            await asyncio.sleep(period_s)
+
+    async def check_api(self, mqtt, period_s):
+        master = self.master
+        while True:
+            if master.req == True:
+                self.publish_state(mqtt)
+                self.send(mqtt, f'{master.uuid}/req', b'false')
+                master.req = False
+            while self.batch_res:
+                self.send(mqtt, f'{master.uuid}/batch', ujson.dumps(self.batch_res.pop(0)))
+            while self.history_req:
+                query = self.history_req.pop(0)
+                uid = query.get("uid")
+                resolution = query.get("resolution", 0)
+                rows = master.history(uid, resolution, query.get("since"))
+                self.send(mqtt, f'{master.uuid}/history',
+                          ujson.dumps({"uid": uid, "resolution": resolution, "rows": rows}))
+            await asyncio.sleep(period_s)
@@ -0,0 +1,145 @@
+from micropython import const
+
+# Weekly watering calendar of an output, stored in its schedule next to startTs/endTs:
+#
+#   "windows":   [[start, duration, days], ...]  start/duration in seconds of the local day,
+#                                                days is a weekday mask, bit 0 = Monday
+#   "seasons":   [[fromTs, toTs], ...]           optional, the calendar is off outside of them
+#   "blackouts": [[fromTs, toTs], ...]           optional, the calendar is off inside of them
+#   "tz":        10800                           optional, offset of the local day from UTC
+#
+# Every weekday is compiled into a sorted list of merged window edges and the date ranges
+# into sorted edge lists, so "is it active" and "when does it change" are binary searches.
+
+DAY = const(86400)
+MAX_STEPS = const(32)
+# longest window, and the largest offset of the local day
+MAX_DURATION = const(7 * 86400)
+MAX_TZ = const(14 * 3600)
+
+
+def _bisect(edges, x):
+    lo = 0
+    hi = len(edges)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < edges[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _edges(intervals):
+    # sorted, merged [start, end) intervals as a flat edge list: inside when the position is odd
+    edges = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if edges and start <= edges[-1]:
+            if end > edges[-1]:
+                edges[-1] = end
+        else:
+            edges.append(start)
+            edges.append(end)
+    return edges
+
+
+def _int(value):
+    # the schedule comes from JSON, every number the calendar compares with a timestamp is an int
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('calendar field not an int')
+    return value
+
+
+def _ranges(ranges):
+    return [(_int(start), _int(end)) for start, end in ranges]
+
+
+def _state(edges, ts):
+    i = _bisect(edges, ts)
+    return i & 1 == 1, edges[i] if i < len(edges) else None
+
+
+class Calendar:
+    def __init__(self, windows, seasons=None, blackouts=None, tz=0):
+        days = [[] for _ in range(7)]
+        for start, duration, mask in windows:
+            if not 0 < _int(duration) <= MAX_DURATION:
+                raise ValueError('bad window duration')
+            _int(start)
+            _int(mask)
+            for weekday in range(7):
+                if not mask & (1 << weekday):
+                    continue
+                day = weekday
+                begin = start % DAY
+                end = begin + duration
+                # a window running past midnight continues on the next weekday
+                while end > 0:
+                    days[day].append((begin, min(end, DAY)))
+                    end -= DAY
+                    begin = 0
+                    day = (day + 1) % 7
+        self.days = [_edges(day) for day in days]
+        self.seasons = _edges(_ranges(seasons)) if seasons else None
+        self.blackouts = _edges(_ranges(blackouts or []))
+        if not -MAX_TZ <= _int(tz) <= MAX_TZ:
+            raise ValueError('bad calendar tz')
+        self.tz = tz
+
+    @classmethod
+    def from_schedule(cls, schedule):
+        if schedule == None or not schedule.get("windows"):
+            return None
+        return cls(schedule["windows"], schedule.get("seasons"), schedule.get("blackouts"), schedule.get("tz", 0))
+
+    def _window_state(self, ts):
+        local = ts + self.tz
+        day = local // DAY
+        sec = local - day * DAY
+        # 1970-01-01 was a Thursday
+        weekday = (day + 3) % 7
+        edges = self.days[weekday]
+        i = _bisect(edges, sec)
+        if i < len(edges):
+            return i & 1 == 1, ts + edges[i] - sec
+        for k in range(1, 8):
+            edges = self.days[(weekday + k) % 7]
+            if edges:
+                return False, ts + k * DAY - sec + edges[0]
+        return False, None
+
+    def _raw(self, ts):
+        # (active, next instant at which one of the inputs changes)
+        season, change = (True, None) if self.seasons == None else _state(self.seasons, ts)
+        blackout, blackout_change = _state(self.blackouts, ts)
+        if blackout_change != None and (change == None or blackout_change < change):
+            change = blackout_change
+        if not season or blackout:
+            return False, change
+        window, window_change = self._window_state(ts)
+        if window_change != None and (change == None or window_change < change):
+            change = window_change
+        return window, change
+
+    def active(self, ts):
+        return self._raw(ts)[0]
+
+    def next_change(self, ts):
+        active, change = self._raw(ts)
+        for _ in range(MAX_STEPS):
+            if change == None:
+                return None
+            state, following = self._raw(change)
+            if state != active:
+                return change
+            change = following
+        return None
+
+    def next_start(self, ts):
+        if self.active(ts):
+            ts = self.next_change(ts)
+            if ts == None:
+                return None
+        return self.next_change(ts)
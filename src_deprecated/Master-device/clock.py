@@ -0,0 +1,82 @@
+import time
+
+from micropython import const
+
+# Corrections larger than this are applied at once, smaller ones are slewed in
+STEP_MS = const(5000)
+SLEW_GAIN = 0.25
+# The drift is measured over at least MIN_SPAN_MS and the reference is renewed after
+# REF_SPAN_MS, well inside the ticks_ms wrap period
+MIN_SPAN_MS = const(3600000)
+REF_SPAN_MS = const(86400000)
+MAX_SKEW = 0.001
+# broadcasts carry whole seconds, on average the true time is half a second later
+SYNC_OFFSET_MS = const(500)
+
+
+class Clock:
+    # UTC time between 'service/time/utc' broadcasts: the last sync is anchored to ticks_ms()
+    # and interpolated with the estimated skew of the local oscillator. The skew is kept apart
+    # from the elapsed ticks so single precision floats only scale the small correction.
+    def __init__(self):
+        self.anchor_utc = None
+        self.anchor_ticks = 0
+        self.skew = 0.0
+        self._ref_utc = None
+        self._ref_ticks = 0
+
+        self.syncs = 0
+        self.steps = 0
+        self.last_error_ms = 0
+
+    def _elapsed(self, ticks):
+        elapsed = time.ticks_diff(ticks, self.anchor_ticks)
+        return elapsed + int(elapsed * self.skew)
+
+    def now_ms(self):
+        if self.anchor_utc == None:
+            return None
+        return self.anchor_utc + self._elapsed(time.ticks_ms())
+
+    def now(self):
+        if self.anchor_utc == None:
+            return None
+        return (self.anchor_utc + self._elapsed(time.ticks_ms())) // 1000
+
+    def sync(self, utc):
+        # returns True when the time jumped (first sync or a large error) and plans must be redone
+        ticks = time.ticks_ms()
+        utc_ms = utc * 1000 + SYNC_OFFSET_MS
+        self.syncs += 1
+        if self.anchor_utc == None:
+            self._reset(utc_ms, ticks)
+            return True
+
+        predicted = self.anchor_utc + self._elapsed(ticks)
+        error = utc_ms - predicted
+        self.last_error_ms = error
+        if error > STEP_MS or error < -STEP_MS:
+            self.steps += 1
+            self._reset(utc_ms, ticks)
+            return True
+
+        span = time.ticks_diff(ticks, self._ref_ticks)
+        if span >= MIN_SPAN_MS:
+            skew = (utc_ms - self._ref_utc - span) / span
+            if -MAX_SKEW < skew < MAX_SKEW:
+                self.skew = skew
+            if span >= REF_SPAN_MS:
+                self._ref_utc = predicted + int(error * SLEW_GAIN)
+                self._ref_ticks = ticks
+        self.anchor_utc = predicted + int(error * SLEW_GAIN)
+        self.anchor_ticks = ticks
+        return False
+
+    def _reset(self, utc_ms, ticks):
+        self.anchor_utc = utc_ms
+        self.anchor_ticks = ticks
+        self._ref_utc = utc_ms
+        self._ref_ticks = ticks
+
+    def stats(self):
+        return {"syncs": self.syncs, "steps": self.steps, "skew": self.skew, "lastErrorMs": self.last_error_ms}
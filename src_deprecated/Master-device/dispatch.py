@@ -0,0 +1,80 @@
+import time
+
+
+class _Route:
+    __slots__ = ('topic', 'levels', 'handler', 'count', 'rejected', 'total_us', 'max_us')
+
+    def __init__(self, topic, handler):
+        self.topic = topic
+        self.levels = topic.split('/') if '+' in topic or '#' in topic else None
+        self.handler = handler
+        self.count = 0
+        self.rejected = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def matches(self, levels):
+        pattern = self.levels
+        for i, level in enumerate(pattern):
+            if level == '#':
+                return True
+            if i >= len(levels) or (level != '+' and level != levels[i]):
+                return False
+        return len(levels) == len(pattern)
+
+
+class Dispatcher:
+    # Received topics are looked up in a dict built once from the subscriptions, wildcard
+    # subscriptions are matched level by level only when no exact topic fits.
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+        self.unmatched = 0
+
+    def add(self, topic, handler):
+        # handler(topic, payload), None only counts the messages
+        route = _Route(topic, handler)
+        if route.levels == None:
+            self.exact[topic] = route
+        else:
+            self.patterns.append(route)
+
+    def topics(self):
+        return list(self.exact) + [route.topic for route in self.patterns]
+
+    def match(self, topic):
+        route = self.exact.get(topic)
+        if route == None and self.patterns:
+            levels = topic.split('/')
+            for candidate in self.patterns:
+                if candidate.matches(levels):
+                    return candidate
+        return route
+
+    def dispatch(self, topic, payload):
+        route = self.match(topic)
+        if route == None:
+            self.unmatched += 1
+            return False
+        start = time.ticks_us()
+        try:
+            if route.handler != None:
+                route.handler(topic, payload)
+        except Exception as e:
+            # malformed payload or a failing handler: the command is dropped, the MQTT loop goes on
+            route.rejected += 1
+            print(f'MQTT rejected topic: "{topic}", {e}')
+        finally:
+            elapsed = time.ticks_diff(time.ticks_us(), start)
+            route.count += 1
+            route.total_us += elapsed
+            if elapsed > route.max_us:
+                route.max_us = elapsed
+        return True
+
+    def stats(self):
+        routes = {}
+        for route in list(self.exact.values()) + self.patterns:
+            routes[route.topic] = {"count": route.count, "rejected": route.rejected, "totalUs": route.total_us,
+                                   "maxUs": route.max_us}
+        return {"routes": routes, "unmatched": self.unmatched}
@@ -0,0 +1,105 @@
+import math
+
+from micropython import const
+
+# Humidity seen by the watering-duration model of an output, set in its schedule:
+#   "filter": {"mode": "median", "size": 5, "maxAge": 10800}
+#   "filter": {"mode": "ema", "tau": 3600, "gate": 15, "maxAge": 10800}
+#   "filter": {"mode": "last"}                            the latest reading, as before
+# Readings older than maxAge seconds are ignored, with no fresh reading the output waters
+# the whole window like it does without a sensor. Readings outside 0..100 are dropped.
+#
+# The EMA weighs a reading by the time since the previous one, 1 - exp(-age / tau), so a
+# burst of packets does not outweigh an hour of history. A reading more than gate away from
+# the average is held back as a spike until GATE_CONFIRM readings in a row agree with it.
+
+MODE_LAST = 'last'
+MODE_MEDIAN = 'median'
+MODE_EMA = 'ema'
+
+DEFAULT_MODE = MODE_MEDIAN
+DEFAULT_SIZE = const(5)
+MAX_SIZE = const(9)
+DEFAULT_TAU = const(3600)
+DEFAULT_GATE = const(15)
+GATE_CONFIRM = const(3)
+DEFAULT_MAX_AGE = const(10800)
+HUMIDITY_MIN = const(0)
+HUMIDITY_MAX = const(100)
+
+
+def _positive(value, name):
+    # settings come from the schedule JSON, a bad one must fail here and not in add() or value()
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+        raise ValueError('bad filter ' + name)
+    return value
+
+
+class HumidityFilter:
+    __slots__ = ('mode', 'size', 'tau', 'gate', 'max_age', 'config', 'values', 'times', 'head', 'ema', 'ema_ts',
+                 'spikes')
+
+    def __init__(self, mode=DEFAULT_MODE, size=DEFAULT_SIZE, tau=DEFAULT_TAU, gate=DEFAULT_GATE, max_age=DEFAULT_MAX_AGE,
+                 config=None):
+        if mode not in (MODE_LAST, MODE_MEDIAN, MODE_EMA):
+            raise ValueError('unknown filter mode')
+        self.mode = mode
+        self.size = 1 if mode == MODE_LAST else min(int(_positive(size, 'size')), MAX_SIZE)
+        self.tau = _positive(tau, 'tau')
+        self.gate = _positive(gate, 'gate')
+        self.max_age = _positive(max_age, 'maxAge')
+        # the schedule entry this filter was built from
+        self.config = config
+        self.values = [0] * self.size
+        self.times = [None] * self.size
+        self.reset()
+
+    @classmethod
+    def from_config(cls, config):
+        if config == None:
+            return cls()
+        return cls(config.get("mode", DEFAULT_MODE), config.get("size", DEFAULT_SIZE), config.get("tau", DEFAULT_TAU),
+                   config.get("gate", DEFAULT_GATE), config.get("maxAge", DEFAULT_MAX_AGE), config)
+
+    def reset(self):
+        for i in range(self.size):
+            self.times[i] = None
+        self.head = 0
+        self.ema = None
+        self.ema_ts = None
+        self.spikes = 0
+
+    def add(self, ts, value):
+        # fixed cost per reading: one ring slot and one EMA step
+        if ts == None or value == None or value < HUMIDITY_MIN or value > HUMIDITY_MAX:
+            return
+        self.values[self.head] = value
+        self.times[self.head] = ts
+        self.head = (self.head + 1) % self.size
+        if self.ema == None or self.ema_ts == None or ts - self.ema_ts > self.max_age:
+            self.ema = value
+            self.spikes = 0
+        elif abs(value - self.ema) > self.gate and self.spikes < GATE_CONFIRM - 1:
+            self.spikes += 1
+            return
+        else:
+            self.ema += (1 - math.exp(-max(ts - self.ema_ts, 0) / self.tau)) * (value - self.ema)
+            self.spikes = 0
+        self.ema_ts = ts
+
+    def _fresh(self, ts, now):
+        return ts != None and (now == None or now - ts <= self.max_age)
+
+    def value(self, now):
+        if self.mode == MODE_EMA:
+            return self.ema if self._fresh(self.ema_ts, now) else None
+        if self.mode == MODE_LAST:
+            return self.values[0] if self._fresh(self.times[0], now) else None
+        fresh = [self.values[i] for i in range(self.size) if self._fresh(self.times[i], now)]
+        if not fresh:
+            return None
+        fresh.sort()
+        middle = len(fresh) // 2
+        if len(fresh) % 2:
+            return fresh[middle]
+        return (fresh[middle - 1] + fresh[middle]) / 2
@@ -0,0 +1,138 @@
+from array import array
+from micropython import const
+
+# Fixed-memory history of one wireless sensor, allocated once per LoRa channel:
+#   raw      the last RAW_SAMPLES packets: ts, humidity, battery, rssi
+#   rollups  humidity min/max/mean per minute, hour and day in rings of ROLLUPS buckets
+# A sensor takes RAW_SAMPLES * 10 + sum(ROLLUPS counts) * 14 bytes of arrays (2.6 KB).
+
+RAW_SAMPLES = const(64)
+# (resolution s, buckets)
+ROLLUPS = ((60, 60), (3600, 48), (86400, 30))
+
+
+class _Rollup:
+    def __init__(self, resolution, buckets):
+        self.resolution = resolution
+        self.ts = array('l', [0] * buckets)
+        self.count = array('H', [0] * buckets)
+        self.sum = array('l', [0] * buckets)
+        self.min = array('h', [0] * buckets)
+        self.max = array('h', [0] * buckets)
+        self.head = -1
+
+    def clear(self):
+        for i in range(len(self.count)):
+            self.count[i] = 0
+        self.head = -1
+
+    def add(self, ts, value):
+        bucket = ts - ts % self.resolution
+        head = self.head
+        if head < 0 or self.ts[head] != bucket:
+            if head >= 0 and bucket < self.ts[head]:
+                # older than the open bucket, the clock went back
+                return
+            head = (head + 1) % len(self.ts)
+            self.head = head
+            self.ts[head] = bucket
+            self.count[head] = 0
+            self.sum[head] = 0
+            self.min[head] = value
+            self.max[head] = value
+        if self.count[head] < 0xFFFF:
+            self.count[head] += 1
+            self.sum[head] += value
+        if value < self.min[head]:
+            self.min[head] = value
+        if value > self.max[head]:
+            self.max[head] = value
+
+    def query(self, since=None):
+        # [[bucket ts, min, max, mean], ...] oldest first
+        rows = []
+        size = len(self.ts)
+        if self.head < 0:
+            return rows
+        for k in range(size):
+            i = (self.head + 1 + k) % size
+            if self.count[i] == 0 or (since != None and self.ts[i] < since):
+                continue
+            rows.append([self.ts[i], self.min[i], self.max[i], self.sum[i] / self.count[i]])
+        return rows
+
+
+class History:
+    def __init__(self, samples=RAW_SAMPLES, rollups=ROLLUPS):
+        self.ts = array('l', [0] * samples)
+        self.humidity = array('h', [0] * samples)
+        self.battery = array('h', [0] * samples)
+        self.rssi = array('h', [0] * samples)
+        self.head = -1
+        self.length = 0
+        self.rollups = [_Rollup(res, buckets) for res, buckets in rollups]
+
+        self.inserts = 0
+
+    def clear(self):
+        self.head = -1
+        self.length = 0
+        for rollup in self.rollups:
+            rollup.clear()
+
+    def mark(self):
+        # what clear() resets, restore() puts it back when a batch is rolled back
+        return self.head, self.length, [(rollup.head, array('H', rollup.count)) for rollup in self.rollups]
+
+    def restore(self, state):
+        self.head, self.length, rollups = state
+        for rollup, (head, count) in zip(self.rollups, rollups):
+            rollup.head = head
+            for i in range(len(count)):
+                rollup.count[i] = count[i]
+
+    def add(self, ts, hum, bat, rssi):
+        head = (self.head + 1) % len(self.ts)
+        self.head = head
+        self.ts[head] = ts
+        self.humidity[head] = hum
+        self.battery[head] = bat
+        self.rssi[head] = rssi
+        if self.length < len(self.ts):
+            self.length += 1
+        for rollup in self.rollups:
+            rollup.add(ts, hum)
+        self.inserts += 1
+
+    def samples(self, since=None):
+        # [[ts, humidity, battery, rssi], ...] oldest first
+        rows = []
+        size = len(self.ts)
+        for k in range(self.length):
+            i = (self.head - self.length + 1 + k) % size
+            if since == None or self.ts[i] >= since:
+                rows.append([self.ts[i], self.humidity[i], self.battery[i], self.rssi[i]])
+        return rows
+
+    def query(self, resolution=0, since=None):
+        if not resolution:
+            return self.samples(since)
+        for rollup in self.rollups:
+            if rollup.resolution == resolution:
+                return rollup.query(since)
+        return None
+
+    def mean(self, since):
+        # humidity mean of the raw samples not older than since, None without samples.
+        # Readings outside 0..100 are skipped like the humidity filter does.
+        total = 0
+        count = 0
+        size = len(self.ts)
+        for k in range(self.length):
+            i = (self.head - k) % size
+            if self.ts[i] < since:
+                break
+            if 0 <= self.humidity[i] <= 100:
+                total += self.humidity[i]
+                count += 1
+        return total / count if count else None
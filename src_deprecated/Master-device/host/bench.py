@@ -0,0 +1,524 @@
+"""Host benchmarks of the Master-device hot paths, one JSON object per line:
+
+  python host/bench.py [--channels 4,16,64] [--quick] [--out bench.jsonl]
+
+The first line describes the run (commit, python), every other line is a result
+{"bench": ..., "channels": ..., "value": ..., "unit": ...}. Timings are CPython figures, use them
+to compare commits with each other, not as ESP32 numbers.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import harness
+
+harness.install()
+
+import ujson
+from pkg import SECTION_LORAS, MasterDevice
+from store import StateStore
+from outputs import OutputDriver
+from scheduler import Scheduler
+from snapshot import Snapshot
+from clock import Clock
+from filters import HumidityFilter
+from history import History
+from telemetry import DeltaTelemetry
+from lora import Lora
+from machine import Pin
+from sx1262 import Sx1262
+import ingest
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=harness.HOST_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timeit(func, ops):
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    return (time.perf_counter() - start) * 1e6 / ops
+
+
+def bench_channels(channels, scale):
+    results = []
+
+    def result(name, value, unit='us/op'):
+        results.append({"bench": name, "channels": channels, "value": round(value, 3), "unit": unit})
+
+    master = harness.make_master(channels)
+    harness.set_time(master)
+    keys = [int(harness.uid(i), 16) for i in range(channels)]
+
+    result('lora_data', _timeit(lambda i: master.lora_data(keys[i % channels], 30 + i % 40, 90, -70), 2000 * scale))
+
+    payload = harness.outputs_payload(channels)
+    payload["wirelessSensors"] = [{"uid": harness.uid(i), "name": "sensor %d" % i} for i in range(channels)]
+    result('update', _timeit(lambda i: master.update(payload), 100 * scale))
+
+    master.convert_to_pkg()
+    result('convert_to_pkg_clean', _timeit(lambda i: master.convert_to_pkg(), 5000 * scale))
+
+    def dirty(i):
+        master.touch(SECTION_LORAS, master.loras[i % channels])
+        master.convert_to_pkg()
+    result('convert_to_pkg_one_dirty', _timeit(dirty, 1000 * scale))
+
+    def full(i):
+        for lora in master.loras:
+            lora.touch()
+        for output in master.outputs:
+            output.touch()
+        master.touch_all()
+        master.convert_to_pkg()
+    result('convert_to_pkg_full', _timeit(full, 200 * scale))
+
+    result('check_outputs_sch', _timeit(lambda i: master.check_outputs_sch(), 2000 * scale))
+
+    result('snapshot_encode', _timeit(lambda i: master.snapshot(), 1000 * scale))
+
+    master.store.request_compaction()
+    master.store.flush(master)
+    for i in range(channels):
+        master.lora_data(keys[i], 55, 80, -60)
+    master.store.flush(master)
+    result('check_last', _timeit(lambda i: master.check_last(), 50 * scale))
+
+    text = ujson.dumps(payload).encode()
+    result('ingest_update', _timeit(lambda i: ingest.command(text, ingest.UPDATE), 100 * scale))
+
+    # delta telemetry against full documents over a day: a packet per sensor every 15 min,
+    # a publish every 15 min, every publish acknowledged
+    telemetry = DeltaTelemetry(master)
+    delta_bytes = 0
+    full_bytes = 0
+    for step in range(96):
+        harness.advance(900)
+        for i in range(channels):
+            master.lora_data(keys[i], 40 + (step + i) % 20, 90 - step // 24, -70 - i % 10)
+        message = telemetry.next()
+        delta_bytes += len(message)
+        full_bytes += len(master.convert_to_pkg())
+        telemetry.ack(ujson.loads(message)["seq"])
+    result('delta_bytes_day', delta_bytes, 'bytes')
+    result('full_bytes_day', full_bytes, 'bytes')
+    return results
+
+
+def bench_snapshot(channels, scale):
+    # boot load of the binary snapshot against the JSON one, outputs with a calendar, a filter and a flow
+    results = []
+
+    def result(name, value, unit):
+        results.append({"bench": name, "channels": channels, "value": round(value, 3), "unit": unit})
+
+    master = harness.make_master(channels)
+    for output in master.outputs:
+        master.schedule_output(output, {"startTs": None, "endTs": None, "windows": [[21600, 1800, 127]],
+                                        "filter": {"mode": "median", "size": 5}, "flow": 1.5})
+    binary = bytes(master.snapshot())
+    text = master.snapshot_json()
+    loaders = (('binary', binary, lambda data: master.load_snapshot(Snapshot(data))),
+               ('json', text, lambda data: master.update_last(ujson.loads(data))))
+    for name, data, load in loaders:
+        result('snapshot_load_' + name, _timeit(lambda i: load(data), 200 * scale), 'us/op')
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        load(data)
+        result('snapshot_load_heap_peak_' + name, tracemalloc.get_traced_memory()[1] - base, 'bytes')
+        tracemalloc.stop()
+        result('snapshot_size_' + name, len(data), 'bytes')
+    return results
+
+
+def bench_journal(channels, entries=1200):
+    # boot after a crash: the snapshot, then the journal of every reading since, one record per packet
+    results = []
+
+    def result(name, value, unit):
+        results.append({"bench": name, "channels": channels, "value": round(value, 3), "unit": unit})
+
+    def boot():
+        store = StateStore(compact_size=1 << 30)
+        start = time.perf_counter()
+        MasterDevice(loras=channels, sensors=channels, outputs=channels, store=store)
+        return (time.perf_counter() - start) * 1000, store.replayed
+
+    master = harness.make_master(channels, store=StateStore(compact_size=1 << 30))
+    harness.set_time(master)
+    keys = [int(harness.uid(i), 16) for i in range(channels)]
+    master.store.request_compaction()
+    master.store.flush(master)
+    result('boot_snapshot', boot()[0], 'ms')
+    for i in range(entries):
+        harness.advance(60)
+        master.lora_data(keys[i % channels], 30 + i % 40, 90, -70)
+        master.store.append(master)
+    elapsed, replayed = boot()
+    result('boot_journal', elapsed, 'ms')
+    result('boot_journal_replayed', replayed, 'records')
+    result('boot_journal_size', master.store.stats()["journalSize"], 'bytes')
+    return results
+
+
+def bench_ingest(scale, channels=12):
+    # an update command of about 2 kB as plain JSON and single-quoted as older backends send it
+    results = []
+    payload = harness.outputs_payload(channels)
+    payload["wirelessSensors"] = [{"uid": harness.uid(i), "name": "sensor %d" % i} for i in range(channels)]
+    double = ujson.dumps(payload).encode()
+    for name, data in (('double', double), ('single', double.replace(b'"', b"'"))):
+        value = _timeit(lambda i: ingest.parse(data), 500 * scale)
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        ingest.parse(data)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        results.append({"bench": 'ingest_parse_' + name, "channels": channels, "value": round(value, 3),
+                        "unit": 'us/op'})
+        results.append({"bench": 'ingest_parse_heap_peak_' + name, "channels": channels, "value": peak,
+                        "unit": 'bytes'})
+    results.append({"bench": 'ingest_payload_size', "channels": channels, "value": len(double), "unit": 'bytes'})
+    return results
+
+
+def bench_outputs(channels=4):
+    # state-change latency up to OutputDriver.write: a manual switch through update(), and a
+    # scheduled start/stop from the planned instant on the device clock, with the scheduler task on real time
+    import utime
+    results = []
+
+    def result(name, values, unit='ms'):
+        for suffix, value in (('_mean', sum(values) / len(values)), ('_max', max(values))):
+            results.append({"bench": name + suffix, "channels": channels, "value": round(value, 3), "unit": unit})
+
+    utime.real()
+    master = harness.make_master(channels)
+    master.sync_time(int(time.time()))
+    driver = OutputDriver(tuple(range(38, 38 + channels)))
+    master.driver = driver
+    written = []
+    write = driver.write
+
+    def timed_write(state):
+        write(state)
+        written.append((time.perf_counter(), master.clock.now_ms(), state))
+    driver.write = timed_write
+
+    latencies = []
+    for i in range(200):
+        output = master.outputs[i % channels]
+        payload = {"outputs": [{"id": output.id, "name": output.name, "value": i // channels % 2 == 0,
+                                "uuidWirelessSensor": output.uuidWirelessSensor, "schedule": output.schedule}]}
+        start = time.perf_counter()
+        master.update(payload)
+        latencies.append((written[-1][0] - start) * 1000)
+    result('output_update_latency', latencies)
+
+    for output in master.outputs:
+        output.value = None
+    master.drive_outputs()
+    now = master.now()
+    planned = set()
+    for i, output in enumerate(master.outputs):
+        master.schedule_output(output, {"startTs": now + 1 + i, "endTs": now + 2 + i})
+        planned.update(((now + 1 + i) * 1000, (now + 3 + i) * 1000))
+    scheduler = Scheduler(master)
+    del written[:]
+    transitions = driver.transitions
+
+    async def run():
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(channels + 4)
+        task.cancel()
+    asyncio.run(run())
+    # every write is matched with the planned instant it served
+    latencies = [min(at - ts for ts in planned if ts <= at) for _, at, _ in written]
+    result('output_transition_latency', latencies)
+    results.append({"bench": 'output_transitions', "channels": channels, "value": driver.transitions - transitions,
+                    "unit": 'transitions'})
+    return results
+
+
+def bench_history(scale):
+    history = History()
+    value = _timeit(lambda i: history.add(harness.T0 + i * 60, 50, 90, -80), 20000 * scale)
+    return [{"bench": 'history_insert', "channels": 1, "value": round(value, 3), "unit": 'us/op'}]
+
+
+def bench_filters():
+    # watering-time error on a 1 h window against the true humidity: 60 days of 15 min packets,
+    # 3 units of noise and 3% corrupted packets
+    results = []
+    for name, config in (('last', {"mode": "last"}), ('median', {"mode": "median", "size": 5}),
+                         ('ema', {"mode": "ema", "tau": 3600, "gate": 15})):
+        rng = random.Random(3)
+        humidity_filter = HumidityFilter.from_config(config)
+        errors = []
+        humidity = 50.0
+        for day in range(60):
+            for k in range(96):
+                humidity = min(max(humidity + rng.gauss(0, 0.5), 20), 80)
+                value = humidity + rng.gauss(0, 3)
+                if rng.random() < 0.03:
+                    value = rng.choice((0, 100, 255))
+                humidity_filter.add(day * 86400 + k * 900, int(value))
+            filtered = humidity_filter.value(day * 86400 + 86399)
+            errors.append(3600 * (humidity - filtered) / 100)
+        mean = sum(errors) / len(errors)
+        std = (sum((e - mean) ** 2 for e in errors) / len(errors)) ** 0.5
+        results.append({"bench": 'filter_error_std_' + name, "channels": 1, "value": round(std, 1), "unit": 's'})
+    return results
+
+
+def bench_clock(scale):
+    # worst error of the interpolated clock over a day, 60 s broadcasts with 0.05..0.8 s latency,
+    # local oscillator 50 ppm fast
+    import utime
+    rng = random.Random(1)
+    clock = Clock()
+    worst = 0
+    next_sync = 0
+    steps = 8640 * scale
+    for step in range(steps):
+        true = step * 10.0
+        utime.set_ms(true * 1000 * (1 + 50e-6))
+        if true >= next_sync:
+            clock.sync(int(harness.T0 + true - rng.uniform(0.05, 0.8)))
+            next_sync += 60 + rng.uniform(-0.5, 0.5)
+        if true > 3600:
+            worst = max(worst, abs(clock.now_ms() / 1000 - (harness.T0 + true)))
+    return [{"bench": 'clock_max_error', "channels": 1, "value": round(worst * 1000, 1), "unit": 'ms'}]
+
+
+def make_lora():
+    dio1 = Pin(46, Pin.IN)
+    radio = Sx1262(dio1)
+    lora = Lora(radio, Pin(11, Pin.OUT), Pin(10, Pin.OUT), radio.busy_line, dio1, Pin(48, Pin.OUT), Pin(47, Pin.OUT))
+    lora.request()
+    return lora, radio
+
+
+def bench_lora_read(scale):
+    # SPI cost of one received packet: interrupt status, buffer state, payload, packet status
+    lora, radio = make_lora()
+    packet = bytes((0x30, 0x00, 0x00, 0x01, 50, 90))
+    ops = 2000 * scale
+    radio.reset_counters()
+    elapsed = 0
+    queue = lora.queue
+    for i in range(ops):
+        radio.receive(packet)
+        start = time.perf_counter()
+        lora.service()
+        queue.sensor(queue.pop())
+        elapsed += time.perf_counter() - start
+    # heap held at once while a packet is handled, CPython objects: compare commits only
+    radio.receive(packet)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    lora.service()
+    queue.sensor(queue.pop())
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return [{"bench": 'lora_read_spi', "channels": 1, "value": round(radio.transactions / ops, 3), "unit": 'transactions'},
+            {"bench": 'lora_read_spi_bytes', "channels": 1, "value": round(radio.bytes / ops, 3), "unit": 'bytes'},
+            {"bench": 'lora_read', "channels": 1, "value": round(elapsed * 1e6 / ops, 3), "unit": 'us/op'},
+            {"bench": 'lora_read_heap_peak', "channels": 1, "value": peak, "unit": 'bytes'}]
+
+
+async def _drain(queue, received, sent, handle_s):
+    # the shape of MasterDevice.lora_rx, handle_s stands for handling that awaits (publish, flash)
+    slot = queue.pop()
+    while slot >= 0:
+        packet = queue.sensor(slot)
+        if packet != None:
+            received.append(time.perf_counter() - sent[packet[0]])
+            if handle_s:
+                await asyncio.sleep(handle_s)
+        slot = queue.pop()
+
+
+async def _consume(queue, received, sent, handle_s):
+    while True:
+        await queue.wait()
+        await _drain(queue, received, sent, handle_s)
+
+
+async def _rx_loop(lora, irq, received, sent, handle_s=0, inline=False):
+    # the shape of main.lora_pkg: woken by DIO1, or polled once a second as before the interrupt path.
+    # inline handles the packets in the rx task itself, as before the queue
+    if irq:
+        lora.attach()
+        poller = asyncio.create_task(lora.poll(10))
+    if not inline:
+        consumer = asyncio.create_task(_consume(lora.queue, received, sent, handle_s))
+    try:
+        while True:
+            if irq:
+                await lora.wait()
+            else:
+                await asyncio.sleep(1)
+            if await lora.wait_busy():
+                continue
+            lora.service()
+            if inline:
+                await _drain(lora.queue, received, sent, handle_s)
+    finally:
+        if irq:
+            poller.cancel()
+        if not inline:
+            consumer.cancel()
+
+
+async def _lora_rx(irq, bursts, size, gap_s, period_s, handle_s=0, inline=False):
+    lora, radio = make_lora()
+    received = []
+    sent = {}
+
+    def sensors():
+        # packets from another thread, as the radio interrupts the running loop
+        for burst in range(bursts):
+            for k in range(size):
+                uid = 0x30000000 + burst * size + k
+                sent[uid] = time.perf_counter()
+                radio.receive(bytes((uid >> 24, uid >> 16 & 0xFF, uid >> 8 & 0xFF, uid & 0xFF, 50, 90)))
+                time.sleep(gap_s)
+            time.sleep(period_s)
+
+    task = asyncio.create_task(_rx_loop(lora, irq, received, sent, handle_s, inline))
+    thread = threading.Thread(target=sensors)
+    thread.start()
+    while thread.is_alive():
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(1.2)
+    task.cancel()
+    return bursts * size - len(received), received, lora.stats()
+
+
+def bench_lora_rx(scale):
+    # bursts of 4 packets 30 ms apart (about the SF7 airtime of a sensor packet), one burst a second
+    import utime
+    utime.real()
+    results = []
+    bursts = 3 if scale == 1 else 8
+    for name, irq in (('poll', False), ('irq', True)):
+        lost, latencies, stats = asyncio.run(_lora_rx(irq, bursts, 4, 0.03, 1.0))
+        latencies.sort()
+        for bench, value, unit in (
+                ('lora_rx_lost_' + name, lost, 'packets'),
+                ('lora_rx_latency_mean_' + name, sum(latencies) / len(latencies) * 1000, 'ms'),
+                ('lora_rx_latency_max_' + name, latencies[-1] * 1000, 'ms')):
+            results.append({"bench": bench, "channels": 1, "value": round(value, 3), "unit": unit})
+    results.append({"bench": 'lora_rx_packets', "channels": 1, "value": bursts * 4, "unit": 'packets'})
+    # DIO1 edges of the interrupt run that came while the previous one was still pending
+    results.append({"bench": 'lora_rx_overruns', "channels": 1, "value": stats["overruns"], "unit": 'irqs'})
+    return results
+
+
+def bench_lora_queue():
+    # a burst of 12 packets 10 ms apart while handling a packet takes 25 ms of awaited work
+    import utime
+    utime.real()
+    results = []
+    for name, inline in (('inline', True), ('queue', False)):
+        lost, latencies, stats = asyncio.run(_lora_rx(True, 1, 12, 0.01, 0.0, 0.025, inline))
+        queue = stats["queue"]
+        for bench, value, unit in (
+                ('lora_queue_lost_' + name, lost, 'packets'),
+                ('lora_queue_dropped_' + name, queue["dropped"], 'packets'),
+                ('lora_queue_high_' + name, queue["high"], 'packets'),
+                ('lora_queue_latency_max_' + name, max(latencies) * 1000, 'ms')):
+            results.append({"bench": bench, "channels": 1, "value": round(value, 3), "unit": unit})
+    return results
+
+
+async def _lora_busy(hold_s):
+    # a packet arrives while the radio holds BUSY for hold_s, a 1 ms ticker stands for the MQTT and
+    # modem tasks that share the loop with the rx task
+    lora, radio = make_lora()
+    received = []
+    sent = {}
+    lag = [0.0]
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag[0] = max(lag[0], time.perf_counter() - start - 0.001)
+
+    tasks = [asyncio.create_task(_rx_loop(lora, True, received, sent)), asyncio.create_task(ticker())]
+    await asyncio.sleep(0.05)
+    lag[0] = 0.0
+    lora.spi_max_us = 0
+    radio.reset_counters()
+    uid = 0x30000001
+    sent[uid] = time.perf_counter()
+    radio.hold_busy(hold_s)
+    radio.receive(bytes((0x30, 0x00, 0x00, 0x01, 50, 90)))
+    await asyncio.sleep(hold_s + 0.1)
+    for task in tasks:
+        task.cancel()
+    return received, lag[0], lora.spi_max_us, radio.ignored
+
+
+def bench_lora_busy():
+    results = []
+    for name, hold_s in (('30ms', 0.03), ('stuck', 0.2)):
+        received, lag, spi_max_us, ignored = asyncio.run(_lora_busy(hold_s))
+        for bench, value, unit in (
+                ('lora_busy_loop_stall_' + name, lag * 1000, 'ms'),
+                ('lora_busy_spi_max_' + name, spi_max_us / 1000, 'ms'),
+                ('lora_busy_ignored_' + name, ignored, 'commands'),
+                ('lora_busy_latency_' + name, received[0] * 1000 if received else None, 'ms')):
+            results.append({"bench": bench, "channels": 1, "value": None if value == None else round(value, 3),
+                            "unit": unit})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', default='4,16,64')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations')
+    parser.add_argument('--out', help='append the results to this file')
+    args = parser.parse_args(argv)
+    scale = 1 if args.quick else 5
+
+    lines = [{"commit": _commit(), "python": platform.python_version(), "quick": args.quick}]
+    with harness.workdir():
+        for channels in [int(c) for c in args.channels.split(',')]:
+            lines += bench_channels(channels, scale)
+            lines += bench_snapshot(channels, scale)
+        lines += bench_journal(4)
+    lines += bench_ingest(scale)
+    with harness.workdir():
+        lines += bench_outputs()
+    lines += bench_history(scale)
+    lines += bench_filters()
+    lines += bench_lora_read(scale)
+    lines += bench_lora_rx(scale)
+    lines += bench_lora_queue()
+    lines += bench_lora_busy()
+    lines += bench_clock(scale)
+
+    text = '\n'.join(json.dumps(line) for line in lines) + '\n'
+    sys.stdout.write(text)
+    if args.out:
+        with open(args.out, 'a') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
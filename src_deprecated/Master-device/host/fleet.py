@@ -0,0 +1,280 @@
+"""Fleet simulator: many master devices in one asyncio loop against an in-process MQTT broker.
+
+  python host/fleet.py [--devices 200] [--seconds 30] [--sensors 4] [--out fleet.jsonl]
+
+Every device is the firmware itself (MasterDevice, App, Scheduler, StateStore) with its own
+clock, state files and a population of LoRa sensors sending packets. A backend task broadcasts
+the time, configures the devices through the command topics and asks for their state with
+'FF09/<uuid>/req', timing the answer on '<uuid>/req'. Time is real, the device periods are
+scaled down by the command line options.
+
+Output is JSON lines like host/bench.py: a line describing the run, then
+{"bench": ..., "devices": ..., "value": ..., "unit": ...}.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import harness
+
+harness.install()
+
+from app import App
+from clock import Clock
+from pkg import MasterDevice
+from scheduler import Scheduler
+from store import StateStore
+
+
+class Broker:
+    # QoS 0 broker: publish() queues, deliver() hands the message to every matching subscription
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+        self.queue = asyncio.Queue()
+
+        self.published = 0
+        self.delivered = 0
+        self.delays = []
+
+    def subscribe(self, topic, callback):
+        if '+' in topic or '#' in topic:
+            self.patterns.append((topic.split('/'), callback))
+        else:
+            self.exact.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.published += 1
+        self.queue.put_nowait((topic, bytes(payload), time.perf_counter()))
+
+    def match(self, topic):
+        callbacks = self.exact.get(topic, [])
+        if self.patterns:
+            levels = topic.split('/')
+            callbacks = callbacks + [callback for pattern, callback in self.patterns if _matches(pattern, levels)]
+        return callbacks
+
+    async def deliver(self):
+        while True:
+            topic, payload, sent = await self.queue.get()
+            self.delays.append(time.perf_counter() - sent)
+            for callback in self.match(topic):
+                callback(topic, payload)
+                self.delivered += 1
+
+
+def _matches(pattern, levels):
+    for i, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(levels) == len(pattern)
+
+
+class SimClient:
+    # the part of lib.umqtt.client.MQTTClient used by App and Spool
+    def __init__(self, broker, client_id, on_message):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_message = on_message
+        self.is_connected = True
+
+    def publish(self, topic, payload, retain=False):
+        self.broker.publish(topic, payload)
+
+    def subscribe(self, topic):
+        self.broker.subscribe(topic, self.on_message)
+
+
+class SimClock(Clock):
+    # a local oscillator off by ppm
+    def __init__(self, ppm):
+        super().__init__()
+        self.ppm = ppm
+
+    def _elapsed(self, ticks):
+        elapsed = time.ticks_diff(ticks, self.anchor_ticks)
+        elapsed += int(elapsed * self.ppm / 1e6)
+        return elapsed + int(elapsed * self.skew)
+
+
+class Device:
+    def __init__(self, n, broker, sensors, rng):
+        self.uuid = 'sim%04d' % n
+        self.master = MasterDevice(
+            store=StateStore(path=self.uuid + '.bin', journal=self.uuid + '.jnl', legacy=self.uuid + '.json'),
+            clock=SimClock(rng.uniform(-50, 50)), max_active=2)
+        self.master.uuid = self.uuid
+        self.scheduler = Scheduler(self.master)
+        self.app = App(self.master)
+        self.mqtt = SimClient(broker, 'device::' + self.uuid, self.app.dispatch)
+        self.app.subscribe(self.mqtt, self.uuid)
+        self.sensors = [(0x20000000 + n * 16 + i, rng.uniform(30, 70)) for i in range(sensors)]
+
+    def start(self, args, rng):
+        master = self.master
+        return [asyncio.create_task(master.store.run(master)),
+                asyncio.create_task(self.scheduler.run()),
+                asyncio.create_task(self.app.publish_pkg(self.mqtt, args.publish_period)),
+                asyncio.create_task(self.app.check_api(self.mqtt, args.api_period)),
+                asyncio.create_task(self.radio(args.lora_period, rng))]
+
+    async def radio(self, period_s, rng):
+        # every sensor sends once per period, at its own phase
+        await asyncio.sleep(rng.uniform(0, period_s))
+        while True:
+            for i, (uid, humidity) in enumerate(self.sensors):
+                humidity = min(max(humidity + rng.gauss(0, 1), 0), 100)
+                self.sensors[i] = (uid, humidity)
+                self.app.lora_packet(self.mqtt, uid, int(humidity), rng.randint(60, 100), rng.randint(-110, -60))
+            await asyncio.sleep(period_s)
+
+
+class Backend:
+    def __init__(self, broker, devices):
+        self.broker = broker
+        self.devices = devices
+        self.pending = {}
+        self.latencies = []
+        broker.subscribe('+/req', self.on_req)
+
+    def on_req(self, topic, payload):
+        sent = self.pending.pop(topic.split('/')[0], None)
+        if payload == b'false' and sent != None:
+            self.latencies.append(time.perf_counter() - sent)
+
+    def broadcast_time(self):
+        self.broker.publish('service/time/utc', str(int(time.time())))
+
+    def configure(self, seconds, rng):
+        # the backend sends plain JSON, the devices parse it through ingest
+        now = int(time.time())
+        for device in self.devices:
+            self.broker.publish(f'FF09/{device.uuid}/batch', _command({"id": 1, "ops": [
+                {"op": "add", "uid": '%08x' % uid, "name": 'sensor %d' % i}
+                for i, (uid, _) in enumerate(device.sensors)]}))
+            outputs = []
+            for i, (uid, _) in enumerate(device.sensors):
+                start = now + rng.randint(1, max(seconds - 5, 1))
+                outputs.append({"id": i + 1, "name": 'output %d' % (i + 1), "value": None,
+                                "uuidWirelessSensor": '%08x' % uid,
+                                "schedule": {"startTs": start, "endTs": start + rng.randint(2, 10)}})
+            self.broker.publish(f'FF09/{device.uuid}/updated', _command({"outputs": outputs}))
+
+    async def run(self, args, rng):
+        next_time = 0
+        while True:
+            if time.monotonic() >= next_time:
+                self.broadcast_time()
+                next_time = time.monotonic() + args.time_period
+            device = rng.choice(self.devices)
+            if device.uuid not in self.pending:
+                self.pending[device.uuid] = time.perf_counter()
+                self.broker.publish(f'FF09/{device.uuid}/req', b'true')
+            await asyncio.sleep(1 / args.req_rate)
+
+
+def _command(data):
+    return json.dumps(data)
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def simulate(args):
+    rng = random.Random(args.seed)
+    broker = Broker()
+    tasks = [asyncio.create_task(broker.deliver())]
+
+    if args.memory:
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0] if args.memory else 0
+    devices = [Device(n, broker, args.sensors, rng) for n in range(args.devices)]
+    built = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    backend = Backend(broker, devices)
+    backend.broadcast_time()
+    backend.configure(args.seconds, rng)
+    await asyncio.sleep(0.1)
+    for device in devices:
+        tasks += device.start(args, rng)
+    tasks.append(asyncio.create_task(backend.run(args, rng)))
+
+    start = time.perf_counter()
+    published = broker.published
+    await asyncio.sleep(args.seconds)
+    elapsed = time.perf_counter() - start
+    published = broker.published - published
+    loaded = tracemalloc.get_traced_memory()[0] if args.memory else 0
+    if args.memory:
+        tracemalloc.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    n = args.devices
+    results = []
+
+    def result(name, value, unit):
+        results.append({"bench": name, "devices": n, "value": None if value == None else round(value, 3),
+                        "unit": unit})
+
+    latencies = backend.latencies
+    result('published', published / elapsed, 'msg/s')
+    result('delivered', broker.delivered, 'msgs')
+    result('broker_delay_p95', (_percentile(broker.delays, 0.95) or 0) * 1000, 'ms')
+    result('req_latency_mean', sum(latencies) / len(latencies) * 1000 if latencies else None, 'ms')
+    result('req_latency_p95', (_percentile(latencies, 0.95) or 0) * 1000, 'ms')
+    result('req_latency_max', max(latencies) * 1000 if latencies else None, 'ms')
+    result('req_answered', len(latencies), 'reqs')
+    result('transitions', sum(device.scheduler.transitions for device in devices), 'transitions')
+    result('store_writes', sum(device.master.store.writes for device in devices), 'writes')
+    result('rejected', sum(route["rejected"] for device in devices
+                           for route in device.app.routes.stats()["routes"].values()), 'msgs')
+    if args.memory:
+        result('memory_per_device_built', (built - base) / n, 'bytes')
+        result('memory_per_device_loaded', (loaded - base) / n, 'bytes')
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--sensors', type=int, default=4, help='LoRa sensors (and outputs) per device')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--lora-period', type=float, default=5, help='seconds between packets of a sensor')
+    parser.add_argument('--publish-period', type=float, default=10, help='seconds between state publishes')
+    parser.add_argument('--api-period', type=float, default=1, help='check_api period of the devices')
+    parser.add_argument('--time-period', type=float, default=10, help='seconds between time broadcasts')
+    parser.add_argument('--req-rate', type=float, default=50, help="state requests per second over the fleet")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc')
+    parser.add_argument('--out', help='append the results to this file')
+    args = parser.parse_args(argv)
+
+    lines = [{"python": platform.python_version(), "devices": args.devices, "sensors": args.sensors,
+              "seconds": args.seconds, "memory": args.memory}]
+    with harness.workdir():
+        lines += asyncio.run(simulate(args))
+
+    text = '\n'.join(json.dumps(line) for line in lines) + '\n'
+    sys.stdout.write(text)
+    if args.out:
+        with open(args.out, 'a') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Runs the Master-device modules under CPython: install() puts the stand-ins of stubs/ (machine,
+# micropython, ubinascii, ujson, ...) in front of the firmware directory on sys.path and gives the
+# time module the MicroPython ticks functions. Time is virtual after set_time(), see stubs/utime.py.
+import os
+import sys
+import tempfile
+import time
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIR = os.path.dirname(HOST_DIR)
+STUBS_DIR = os.path.join(HOST_DIR, 'stubs')
+
+T0 = 1700000000
+
+
+def install():
+    for path in (FIRMWARE_DIR, STUBS_DIR):
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+    import utime
+    for name in ('ticks_ms', 'ticks_us', 'ticks_add', 'ticks_diff', 'sleep_ms', 'sleep_us'):
+        setattr(time, name, getattr(utime, name))
+
+
+def set_time(master, utc=T0):
+    # virtual ticks from here on, the master clock synced to utc
+    import utime
+    utime.set_ms(0)
+    master.sync_time(utc)
+
+
+def advance(seconds):
+    import utime
+    utime.advance_ms(seconds * 1000)
+
+
+class workdir:
+    # the store and the spool write to the current directory, keep them in a temporary one
+    def __enter__(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._cwd = os.getcwd()
+        os.chdir(self._tmp.name)
+        return self._tmp.name
+
+    def __exit__(self, *exc):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+
+def uid(i):
+    return '%08x' % (0x10000000 + i)
+
+
+def outputs_payload(count, start=T0 + 3600, length=1800, bind=True):
+    return {"outputs": [{"id": i + 1, "name": "output %d" % (i + 1), "value": None,
+                         "uuidWirelessSensor": uid(i) if bind else None,
+                         "schedule": {"startTs": start + 60 * i, "endTs": start + 60 * i + length}}
+                        for i in range(count)]}
+
+
+def make_master(channels, **kwargs):
+    # a MasterDevice with every LoRa channel in use and every output bound to one of them
+    from pkg import MasterDevice
+    master = MasterDevice(loras=channels, sensors=channels, outputs=channels, **kwargs)
+    for i in range(channels):
+        master.add_lora('sensor %d' % i, uid(i))
+    master.update(outputs_payload(channels))
+    master.req = False
+    return master
@@ -0,0 +1,105 @@
+# Host stand-in for the parts of machine used by the firmware. Pins keep their level, and
+# writes to the ESP32-S3 GPIO set/clear registers through mem32 switch the matching output pins.
+
+_UNIQUE_ID = b'\x01\x02\x03\x04\x05\x06'
+
+_W1TS = {0x60004008: 0, 0x60004014: 32}
+_W1TC = {0x6000400C: 0, 0x60004018: 32}
+
+# gpio number -> last Pin created for it
+pins = {}
+
+
+def unique_id():
+    return _UNIQUE_ID
+
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode=None, pull=None, value=None):
+        self.id = id
+        self.mode = mode
+        self.level = value or 0
+        self.writes = 0
+        self.handler = None
+        pins[id] = self
+
+    def __call__(self, value=None):
+        if value == None:
+            return self.level
+        self.level = 1 if value else 0
+        self.writes += 1
+
+    value = __call__
+
+    def on(self):
+        self(1)
+
+    def off(self):
+        self(0)
+
+    def irq(self, handler=None, trigger=None):
+        self.handler = handler
+
+    def trigger(self):
+        # host only: an edge on an input pin
+        if self.handler != None:
+            self.handler(self)
+
+
+class _Mem32(dict):
+    def __getitem__(self, address):
+        return dict.get(self, address, 0)
+
+    def __setitem__(self, address, value):
+        dict.__setitem__(self, address, value)
+        for registers, level in ((_W1TS, 1), (_W1TC, 0)):
+            base = registers.get(address)
+            if base != None:
+                for bit in range(32):
+                    if value & (1 << bit) and base + bit in pins:
+                        pins[base + bit].level = level
+                        pins[base + bit].writes += 1
+
+
+mem32 = _Mem32()
+
+
+class SPI:
+    def __init__(self, id=None, baudrate=None, sck=None, mosi=None, miso=None, **kwargs):
+        self.id = id
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        pass
+
+    def read(self, nbytes, write=0x00):
+        return bytes(nbytes)
+
+    def readinto(self, buf, write=0x00):
+        for i in range(len(buf)):
+            buf[i] = 0
+
+    def write_readinto(self, write_buf, read_buf):
+        for i in range(len(read_buf)):
+            read_buf[i] = 0
+
+
+class UART:
+    def __init__(self, *args, **kwargs):
+        pass
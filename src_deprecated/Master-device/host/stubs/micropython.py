@@ -0,0 +1,14 @@
+# Host stand-in for the MicroPython builtin module
+
+
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+
+def mem_info(verbose=None):
+    pass
@@ -0,0 +1,29 @@
+# Host stand-in: asyncio plus the MicroPython extras
+import asyncio as _asyncio
+
+from asyncio import *
+
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
+
+
+class ThreadSafeFlag:
+    # set() may be called from another thread, which stands in for a hard interrupt
+    def __init__(self):
+        self._event = Event()
+        self._loop = None
+
+    def set(self):
+        if self._loop == None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        self._loop = get_running_loop()
+        await self._event.wait()
+        self._event.clear()
@@ -0,0 +1,2 @@
+# Host stand-in: CPython binascii has hexlify and crc32(data, crc) with the same semantics
+from binascii import *
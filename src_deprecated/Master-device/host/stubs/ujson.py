@@ -0,0 +1,11 @@
+# Host stand-in: the CPython json defaults (', ' and ': ' separators) match MicroPython's ujson.dumps
+import json as _json
+
+from json import dumps
+
+
+def loads(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    return _json.loads(data)
+
@@ -0,0 +1,58 @@
+# Host stand-in for the ticks functions of the MicroPython time module.
+#
+# Ticks wrap like on the ESP32 (30 bit). They follow the host clock until set_ms() switches to
+# virtual time, which then only moves with advance_ms(); simulations drive time that way.
+import time as _time
+
+TICKS_PERIOD = 1 << 30
+_TICKS_HALF = TICKS_PERIOD // 2
+
+_virtual_us = None
+
+
+def set_ms(ms):
+    global _virtual_us
+    _virtual_us = int(ms * 1000)
+
+
+def advance_ms(ms):
+    global _virtual_us
+    if _virtual_us == None:
+        set_ms(_time.monotonic() * 1000)
+    _virtual_us += int(ms * 1000)
+
+
+def real():
+    global _virtual_us
+    _virtual_us = None
+
+
+def _now_us():
+    return _virtual_us if _virtual_us != None else int(_time.monotonic() * 1000000)
+
+
+def ticks_ms():
+    return (_now_us() // 1000) % TICKS_PERIOD
+
+
+def ticks_us():
+    return _now_us() % TICKS_PERIOD
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def ticks_diff(end, start):
+    return (end - start + _TICKS_HALF) % TICKS_PERIOD - _TICKS_HALF
+
+
+def sleep_ms(ms):
+    if _virtual_us != None:
+        advance_ms(ms)
+    else:
+        _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    sleep_ms(us / 1000)
@@ -0,0 +1,140 @@
+# Host model of the SX1262 as seen through lora.Lora: an SPI stand-in answering the commands the
+# receive path uses, driving the DIO1 pin. receive() may be called from another thread to deliver a
+# packet asynchronously, like the radio does.
+#
+# Like the radio in continuous RX, every packet is written at the RX base address, so a packet
+# that is not read before the next one arrives is lost. BUSY is high for busy_us after every
+# command, or as long as hold_busy() says; a command sent while BUSY is high is ignored.
+import threading
+import time
+
+IRQ_RX_DONE = 0x0002
+IRQ_HEADER_ERR = 0x0020
+IRQ_CRC_ERR = 0x0040
+IRQ_TIMEOUT = 0x0200
+
+_STDBY_RC = 0x20
+_STDBY_XOSC = 0x30
+_RX = 0x50
+
+
+class _Busy:
+    def __init__(self, radio):
+        self.radio = radio
+
+    def __call__(self, value=None):
+        return 1 if time.perf_counter() < self.radio.busy_until else 0
+
+    value = __call__
+
+
+class Sx1262:
+    def __init__(self, dio1, busy_us=5):
+        self.dio1 = dio1
+        # pass busy_line to Lora as its BUSY pin
+        self.busy_line = _Busy(self)
+        self.busy_us = busy_us
+        self.busy_until = 0.0
+        self.buffer = bytearray(256)
+        self.registers = bytearray(0x1000)
+        self.irq = 0
+        self.irq_mask = 0
+        self.mode = _STDBY_RC
+        self.rx_length = 0
+        self.packet_status = (0, 0, 0)
+        self._lock = threading.Lock()
+
+        self.transactions = 0
+        self.bytes = 0
+        self.packets = 0
+        self.ignored = 0
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.ignored = 0
+
+    def hold_busy(self, seconds):
+        self.busy_until = max(self.busy_until, time.perf_counter() + seconds)
+
+    def receive(self, payload, rssi=-80, snr=8, crc_ok=True):
+        with self._lock:
+            self.buffer[:len(payload)] = payload
+            self.rx_length = len(payload)
+            self.packet_status = (-2 * rssi & 0xFF, snr * 4 & 0xFF, -2 * rssi & 0xFF)
+            self.irq |= IRQ_RX_DONE if crc_ok else IRQ_RX_DONE | IRQ_CRC_ERR
+            self.packets += 1
+            rising = self.dio1.level == 0 and self.irq & self.irq_mask
+            if rising:
+                self.dio1.level = 1
+        if rising:
+            self.dio1.trigger()
+
+    # machine.SPI
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        self._transfer(buf, None)
+
+    def write_readinto(self, write_buf, read_buf):
+        self._transfer(write_buf, read_buf)
+
+    def readinto(self, buf, write=0x00):
+        # a continuation of the last command is not modelled
+        for i in range(len(buf)):
+            buf[i] = 0
+
+    def _transfer(self, tx, rx):
+        self.transactions += 1
+        self.bytes += len(tx)
+        if self.busy_line():
+            self.ignored += 1
+            data, offset, at = (), 0, 0
+        else:
+            with self._lock:
+                data, offset, at = self._command(tx)
+            self.hold_busy(self.busy_us / 1e6)
+        if rx != None:
+            # copied without slicing, so the model allocates little next to the driver
+            for i in range(len(rx)):
+                rx[i] = 0
+            for i in range(min(len(data) - offset, len(rx) - at)):
+                rx[at + i] = data[offset + i]
+
+    def _command(self, tx):
+        # returns the answer: a sequence, where it starts and where it goes in the rx buffer
+        op = tx[0]
+        if op == 0x12:
+            return (self.irq >> 8, self.irq & 0xFF), 0, 2
+        if op == 0x13:
+            return (self.rx_length, 0), 0, 2
+        if op == 0x14:
+            return self.packet_status, 0, 2
+        if op == 0x17:
+            return (0, 0), 0, 2
+        if op == 0xC0:
+            return (self.mode,), 0, 2
+        if op == 0x1E:
+            return self.buffer, tx[1], 3
+        if op == 0x1D:
+            return self.registers, tx[1] << 8 | tx[2], 4
+        if op == 0x0D:
+            address = tx[1] << 8 | tx[2]
+            for i in range(3, len(tx)):
+                self.registers[address + i - 3] = tx[i]
+        elif op == 0x02:
+            self.irq &= ~(tx[1] << 8 | tx[2])
+            if self.irq & self.irq_mask == 0:
+                self.dio1.level = 0
+        elif op == 0x08:
+            self.irq_mask = tx[3] << 8 | tx[4]
+        elif op == 0x80:
+            self.mode = _STDBY_RC if tx[1] == 0 else _STDBY_XOSC
+        elif op == 0x82:
+            self.mode = _RX
+        return (), 0, 0
@@ -0,0 +1,82 @@
+# Batch commands, all operations or none: python -m pytest host
+import json
+
+import pytest
+
+import harness
+
+harness.install()
+
+from app import App, BATCH_PENDING
+
+CHANNELS = 4
+T0 = harness.T0
+
+
+@pytest.fixture(autouse=True)
+def workdir():
+    with harness.workdir():
+        yield
+
+
+def state(master):
+    records = [record.to_dict() for record in master.loras + master.sensors + master.outputs]
+    histories = [master.history(harness.uid(i)) for i in range(CHANNELS)]
+    return records, dict(master.lora_index), histories
+
+
+def filled_master():
+    master = harness.make_master(CHANNELS)
+    harness.set_time(master)
+    for step in range(5):
+        harness.advance(60)
+        for i in range(CHANNELS):
+            master.lora_data(int(harness.uid(i), 16), 40 + step + i, 90, -70)
+    return master
+
+
+@pytest.mark.parametrize('ops, error', (
+    ([{"op": "add", "uid": harness.uid(0)}], 'op 0: uid exists'),
+    ([{"op": "add", "uid": harness.uid(9)}], 'op 0: no free channel'),
+    ([{"op": "remove", "uid": harness.uid(1)}, {"op": "rename", "uid": harness.uid(1)}], 'op 1: unknown uid'),
+    ([{"op": "remove", "uid": "xyz"}], 'op 0: bad uid'),
+    ([{"op": "bind", "id": 99}], 'op 0: unknown output'),
+    ([{"op": "remove", "uid": harness.uid(2)}, {"op": "bind", "id": 1, "uid": harness.uid(2)}], 'op 1: unknown uid'),
+    ([{"op": "reboot"}], 'op 0: unknown op'),
+))
+def test_check_rejects_before_applying(ops, error):
+    master = filled_master()
+    before = state(master)
+    with pytest.raises(ValueError) as info:
+        master.batch(ops)
+    assert str(info.value) == error
+    assert state(master) == before
+
+
+def test_failed_operation_rolls_back(monkeypatch):
+    # the new sensor takes the freed channel and clears its history, then the last operation fails
+    master = filled_master()
+    before = state(master)
+
+    def fail(output, schedule):
+        raise OSError('flash full')
+    monkeypatch.setattr(master, 'schedule_output', fail)
+    with pytest.raises(OSError):
+        master.batch([{"op": "remove", "uid": harness.uid(1)},
+                      {"op": "add", "uid": harness.uid(9), "name": "new"},
+                      {"op": "rename", "uid": harness.uid(0), "name": "renamed"},
+                      {"op": "schedule", "id": 1, "schedule": None}])
+    assert state(master) == before
+    assert master.find_lora(harness.uid(9)) == None
+
+
+def test_results_are_capped():
+    master = filled_master()
+    app = App(master)
+    payload = json.dumps({"id": 1, "ops": [{"op": "reboot"}]}).encode()
+    for i in range(BATCH_PENDING):
+        app.on_batch('batch', payload)
+    assert [result["ok"] for result in app.batch_res] == [False] * BATCH_PENDING
+    with pytest.raises(ValueError):
+        app.on_batch('batch', json.dumps({"id": 2, "ops": [{"op": "remove", "uid": harness.uid(1)}]}).encode())
+    assert master.find_lora(harness.uid(1)) != None
@@ -0,0 +1,161 @@
+# Scheduler and output switching on virtual time: python -m pytest host
+import asyncio
+import random
+
+import pytest
+
+import harness
+
+harness.install()
+
+from scheduler import Scheduler
+
+import utime
+
+T0 = harness.T0
+
+
+@pytest.fixture(autouse=True)
+def workdir():
+    with harness.workdir():
+        yield
+
+
+def run_for(scheduler, seconds):
+    # the scheduler task on a real event loop, the clock is virtual and does not move meanwhile
+    async def go():
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(seconds)
+        task.cancel()
+    asyncio.run(go())
+
+
+class _Idle:
+    # an output that is due but that check_output leaves as it is
+    def __init__(self):
+        self.outputs = [object()]
+        self.scheduler = None
+        self.clock = self
+        self.checks = 0
+
+    def now(self):
+        return T0
+
+    def now_ms(self):
+        return T0 * 1000
+
+    def output_transition(self, output, now):
+        return T0 - 5
+
+    def check_output(self, output):
+        self.checks += 1
+
+
+def test_idle_entry_does_not_spin():
+    master = _Idle()
+    scheduler = Scheduler(master)
+    run_for(scheduler, 0.2)
+    assert master.checks == 1
+    assert scheduler.wakeups == 0
+
+
+def test_jittered_syncs_keep_switching_on_time():
+    # two days, the local oscillator 50 ppm fast, a broadcast every 60 +- 0.5 s that arrives
+    # 0.05..0.8 s late. Every switch happens within a second of its instant: an output starts at
+    # startTs and stops once the clock is past hum_endTs.
+    rng = random.Random(9)
+    master = harness.make_master(2)
+    scheduler = Scheduler(master)
+    true = 0.0
+    next_sync = 0.0
+    switches = []
+    state = [False] * len(master.outputs)
+    while true < 2 * 86400:
+        utime.set_ms(true * 1000 * (1 + 50e-6))
+        if true >= next_sync:
+            master.sync_time(int(T0 + true - rng.uniform(0.05, 0.8)))
+            next_sync += 60 + rng.uniform(-0.5, 0.5)
+        if scheduler._dirty:
+            scheduler.plan()
+        planned = {slot: ts for ts, slot in scheduler.heap}
+        scheduler.fire()
+        for slot, output in enumerate(master.outputs):
+            if output.ontime != state[slot]:
+                state[slot] = output.ontime
+                switches.append((T0 + true, planned[slot]))
+        delay = scheduler.delay()
+        true += 0.05 if delay != None and delay < 2 else 1.0
+
+    # every output starts and stops once a day
+    assert len(switches) == 8
+    for at, planned in switches:
+        assert abs(at - planned) <= 1.0
+
+
+def _running_output():
+    master = harness.make_master(2)
+    harness.set_time(master)
+    scheduler = Scheduler(master)
+    master.schedule_output(master.outputs[0], {"startTs": T0, "endTs": T0 + 600})
+    scheduler.plan()
+    scheduler.fire()
+    assert master.outputs[0].ontime
+    return master, scheduler
+
+
+def _step(scheduler, seconds):
+    harness.advance(seconds)
+    if scheduler._dirty:
+        scheduler.plan()
+    scheduler.fire()
+
+
+@pytest.mark.parametrize('schedule', ({"windows": [[3600, 600, 127]]}, None))
+def test_running_output_stops_after_schedule_change(schedule):
+    master, scheduler = _running_output()
+    output = master.outputs[0]
+    master.update({"outputs": [{"id": output.id, "name": output.name, "value": None,
+                                "uuidWirelessSensor": output.uuidWirelessSensor, "schedule": schedule}]})
+    _step(scheduler, 300)
+    assert output.ontime
+    _step(scheduler, 301)
+    assert not output.ontime
+
+
+@pytest.mark.parametrize('bad', ({"tz": 10800.0}, {"tz": "10800"}, {"windows": [[3600, 30 * 86400, 127]]}))
+def test_bad_calendar_is_dropped(bad):
+    master = harness.make_master(2)
+    harness.set_time(master)
+    schedule = {"startTs": None, "endTs": None, "windows": [[3600, 600, 127]]}
+    schedule.update(bad)
+    master.schedule_output(master.outputs[0], schedule)
+    assert master.outputs[0].calendar == None
+    master.check_outputs_sch()
+
+
+def test_reset_filter_uses_sensor_history():
+    master = harness.make_master(2)
+    harness.set_time(master)
+    key = int(harness.uid(0), 16)
+    for humidity in (40, 50, 255, 60):
+        harness.advance(60)
+        master.lora_data(key, humidity, 90, -70)
+    output = master.outputs[0]
+    output.filter.reset()
+    # mean of 40, 50 and 60, the corrupted 255 is skipped: half of a 1000 s window
+    assert master.hum_out_math(output, T0, T0 + 1000) == T0 + 500
+
+
+@pytest.mark.parametrize('bad', ({"maxAge": None}, {"gate": "x"}, {"tau": 0}, {"size": "5"}))
+def test_bad_filter_settings_fall_back(bad):
+    master = harness.make_master(2)
+    harness.set_time(master)
+    config = {"mode": "ema"}
+    config.update(bad)
+    output = master.outputs[0]
+    master.schedule_output(output, {"startTs": T0 + 60, "endTs": T0 + 660, "filter": config})
+    assert output.filter.config == None
+    master.lora_data(int(harness.uid(0), 16), 50, 90, -70)
+    harness.advance(120)
+    master.check_output(output)
+    assert output.ontime
@@ -0,0 +1,88 @@
+import ujson
+
+# Command payloads are parsed straight from the received buffer: the wire convention is plain
+# double-quoted JSON, which goes to ujson.loads without a copy. Older backends send Python style
+# single-quoted JSON; when such a payload does not parse it is requoted with one bytes.replace, a
+# copy of the payload that lives only while it is parsed.
+#
+# Schemas are built once: field -> (accepted types, required, schema of list items or None).
+# Unknown fields are ignored, a missing required field or a wrong type raises ValueError.
+
+QUOTE_DOUBLE = b'"'
+QUOTE_SINGLE = b"'"
+
+_NONE = type(None)
+
+
+def parse(payload):
+    # payload: bytes or bytearray
+    try:
+        return ujson.loads(payload)
+    except ValueError:
+        if QUOTE_SINGLE not in payload:
+            raise
+    return ujson.loads(bytes(payload).replace(QUOTE_SINGLE, QUOTE_DOUBLE))
+
+
+def validate(data, schema, path='payload'):
+    if not isinstance(data, dict):
+        raise ValueError(path + ': object expected')
+    for name, (types, required, items) in schema.items():
+        value = data.get(name)
+        if value == None:
+            if required:
+                raise ValueError(path + '.' + name + ': missing')
+            continue
+        if not isinstance(value, types):
+            raise ValueError(path + '.' + name + ': wrong type')
+        if items != None:
+            for each in value:
+                validate(each, items, path + '.' + name)
+    return data
+
+
+UID = (str, int)
+
+WIRELESS_SENSOR = {
+    "uid": (UID, True, None),
+    "name": ((str, _NONE), False, None),
+}
+OUTPUT = {
+    "id": (int, True, None),
+    "name": ((str, _NONE), False, None),
+    "value": ((bool, int, _NONE), False, None),
+    "uuidWirelessSensor": ((str, int, _NONE), False, None),
+    "schedule": ((dict, _NONE), False, None),
+}
+UPDATE = {
+    "wirelessSensors": (list, False, WIRELESS_SENSOR),
+    "outputs": (list, False, OUTPUT),
+}
+ADD_WIRELESS_SENSOR = {
+    "uid": (UID, True, None),
+    "name": (str, False, None),
+}
+REMOVE_WIRELESS_SENSOR = {
+    "uid": (UID, True, None),
+}
+HISTORY = {
+    "uid": (UID, True, None),
+    "resolution": (int, False, None),
+    "since": (int, False, None),
+}
+# MasterDevice.check_batch checks which fields each op needs
+BATCH_OP = {
+    "op": (str, True, None),
+    "uid": ((str, int, _NONE), False, None),
+    "name": ((str, _NONE), False, None),
+    "id": (int, False, None),
+    "schedule": ((dict, _NONE), False, None),
+}
+BATCH = {
+    "id": ((str, int, _NONE), False, None),
+    "ops": (list, True, BATCH_OP),
+}
+
+
+def command(payload, schema):
+    return validate(parse(payload), schema)
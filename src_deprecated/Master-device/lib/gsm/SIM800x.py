@@ -347,7 +347,8 @@ class SIM800x(AsyncTask):
         await self._cmd('+++', prefix=None, timeout=0)
         await asyncio.sleep_ms(1000)  # No characters entered for T1 time (1 second)
 
-        self._connect.release()
+        if self._connect.locked():
+            self._connect.release()
 
     @property
     def is_sim_card_ready(self) -> bool:
@@ -360,3 +361,7 @@ class SIM800x(AsyncTask):
     @property
     def is_gprs_attached(self) -> bool:
         return self._gprs_attached == 1
+
+    @property
+    def is_ppp_connected(self) -> bool:
+        return self._modem is not None and self._modem.isconnected()
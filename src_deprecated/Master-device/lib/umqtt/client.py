@@ -128,11 +128,18 @@ class MQTTClient(AsyncTask):
             else:
                 self.log.error(f'Disconnected: {kwargs}')
 
-        self._socket.close()
-        self._socket = None
+        self._close_socket()
 
         self._emit_event(MQTTClient.EVENT_DISCONNECTED, kwargs)
 
+    def _close_socket(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
     def _on_received_msg(self, data: bytes):
         _offset = 0
         while _offset < (len(data) - 1):
@@ -226,6 +233,8 @@ class MQTTClient(AsyncTask):
         self._clean_session = kwargs.get('clean_session', self._clean_session)
         self._keepalive_period = kwargs.get('keepalive_period', self._keepalive_period)
 
+        # the socket of an attempt that timed out before CONNACK
+        self._close_socket()
         self._socket = socket.socket()
         self.log.debug(f'Connecting to {self._host}:{self._port}')
 
@@ -234,6 +243,7 @@ class MQTTClient(AsyncTask):
             self.log.debug(f'getaddrinfo: {_addr}')
         except Exception as e:
             self.log.error(f'getaddrinfo: {str(e)}')
+            self._close_socket()
             return
 
         try:
@@ -241,6 +251,7 @@ class MQTTClient(AsyncTask):
             self._socket.settimeout(0.001)
         except Exception as e:
             self.log.error(f'socket connect: {str(e)}')
+            self._close_socket()
             return
 
         if self._ssl is not None:
@@ -1,10 +1,22 @@
 import time
+import uasyncio as asyncio
 
 from machine import SPI, Pin
-from ubinascii import hexlify
+from micropython import const
+from rxqueue import RxQueue, IRQ_RX_DONE, IRQ_HEADER_ERR
+
+# largest LoRa payload, the receive buffers are allocated once for it
+RX_MAX = const(255)
+# longest command frame: SetPacketParams is an opcode and 9 parameters
+CMD_MAX = const(16)
+# BUSY: a command spins on it for at most BUSY_BLOCK_US. wait_busy() spins BUSY_SPIN_US, then
+# yields to the loop until BUSY_TIMEOUT_MS, which covers reset, TCXO start and calibration.
+BUSY_SPIN_US = const(100)
+BUSY_BLOCK_US = const(1000)
+BUSY_TIMEOUT_MS = const(50)
 
 class Lora:
-    def __init__(self, spi: SPI, cs: Pin, reset: Pin, busy: Pin, dio1: Pin, txen: Pin, rxen: Pin):
+    def __init__(self, spi: SPI, cs: Pin, reset: Pin, busy: Pin, dio1: Pin, txen: Pin, rxen: Pin, queue=None):
         self.spi = spi
         self.cs = cs
         self.reset = reset
@@ -21,56 +33,164 @@ class Lora:
         self.rssi_signal = 0
         self.status = 0
 
+        # Command frames are built in tx and answered in rx, both allocated once. frame_tx[n] and
+        # frame_rx[n] are views of their first n bytes, so sending a command slices nothing.
+        self.tx = bytearray(CMD_MAX)
+        self.rx = bytearray(CMD_MAX)
+        tx = memoryview(self.tx)
+        rx = memoryview(self.rx)
+        self.frame_tx = [tx[:n] for n in range(CMD_MAX + 1)]
+        self.frame_rx = [rx[:n] for n in range(CMD_MAX + 1)]
+
+        # ReadBuffer command and answer of the burst payload read, see read()
+        self.rx_tx = bytearray(3 + RX_MAX)
+        self.rx_buf = bytearray(3 + RX_MAX)
+        self.rx_tx_mv = memoryview(self.rx_tx)
+        self.rx_mv = memoryview(self.rx_buf)
+        self.rx_tx[0] = 0x1E
+        # payload size -> views of the burst buffers, made once per size
+        self.rx_views = {}
+
+        # DIO1 interrupt -> rx task bridge, see isr() and service()
+        self.flag = asyncio.ThreadSafeFlag()
+        self.irq_pending = False
+        self.irq_ticks = 0
+        self.rx_ticks = 0
+        self.irqs = 0
+        self.overruns = 0
+        # received packets with their metadata, consumed by MasterDevice.lora_rx
+        self.queue = queue if queue != None else RxQueue()
+
+        # SPI commands, the longest one (BUSY wait included) and those sent with BUSY still high
+        self.spi_count = 0
+        self.spi_max_us = 0
+        self.busy_timeouts = 0
+        self.busy_yields = 0
+
 #============================SPI_FUNC==========================
         
     def spi_read_write(self, tx_buf, rx_buf):
-        self.check_busy()
+        start = time.ticks_us()
+        if self.check_busy():
+            self.busy_timeouts += 1
         self.cs.value(0)
         self.spi.write_readinto(tx_buf, rx_buf)
         self.cs.value(1)
+        self.spi_done(start)
 
     def spi_write(self, tx_buf):
-        self.check_busy()
+        start = time.ticks_us()
+        if self.check_busy():
+            self.busy_timeouts += 1
         self.cs.value(0)
         self.spi.write(tx_buf)
         self.cs.value(1)
+        self.spi_done(start)
+
+    def spi_done(self, start):
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        self.spi_count += 1
+        if elapsed > self.spi_max_us:
+            self.spi_max_us = elapsed
+
+    def spi_transfer(self, size):
+        # tx[:size] out, the answer in rx[:size]
+        self.spi_read_write(self.frame_tx[size], self.frame_rx[size])
+
+    def spi_send(self, size):
+        self.spi_write(self.frame_tx[size])
+
+    # Fixed-layout commands of the receive path, they neither build nor return a buffer
+
+    def spi_write_cmd1(self, cmd, p0):
+        tx = self.tx
+        tx[0] = cmd
+        tx[1] = p0
+        self.spi_send(2)
+
+    def spi_write_cmd2(self, cmd, p0, p1):
+        tx = self.tx
+        tx[0] = cmd
+        tx[1] = p0
+        tx[2] = p1
+        self.spi_send(3)
+
+    def spi_read_cmd_into(self, cmd, rx_size):
+        # the answer is at rx[2:2 + rx_size]
+        tx = self.tx
+        tx[0] = cmd
+        for i in range(1, rx_size + 2):
+            tx[i] = 0
+        self.spi_transfer(rx_size + 2)
+        return self.rx
+
+    def spi_write_register1(self, addr, value):
+        tx = self.tx
+        tx[0] = 0x0D
+        tx[1] = (addr >> 8) & 0xFF
+        tx[2] = addr & 0xFF
+        tx[3] = value
+        self.spi_send(4)
+
+    def spi_read_register1(self, addr):
+        tx = self.tx
+        tx[0] = 0x1D
+        tx[1] = (addr >> 8) & 0xFF
+        tx[2] = addr & 0xFF
+        tx[3] = 0
+        tx[4] = 0
+        self.spi_transfer(5)
+        return self.rx[4]
+
+    # Any length, for the setup commands: the answers are copies
 
     def spi_read_register(self, addr, rx_size):
-        tx_data = [0x1D, (addr >> 8) & 0xFF, addr & 0xFF, 0x00]
-        for i in range (rx_size):
-            tx_data.append(0)
-        rx_data = bytearray(len(tx_data))
-        self.spi_read_write(bytearray(tx_data), rx_data)
-        return rx_data[4:]
+        tx = self.tx
+        tx[0] = 0x1D
+        tx[1] = (addr >> 8) & 0xFF
+        tx[2] = addr & 0xFF
+        for i in range(3, rx_size + 4):
+            tx[i] = 0
+        self.spi_transfer(rx_size + 4)
+        return bytes(self.frame_rx[rx_size + 4][4:])
 
     def spi_write_register(self, addr, buf):
-        tx_data = [0x0D, (addr >> 8) & 0xFF, addr & 0xFF]
+        tx = self.tx
+        tx[0] = 0x0D
+        tx[1] = (addr >> 8) & 0xFF
+        tx[2] = addr & 0xFF
+        size = 3
         for i in buf:
-            tx_data.append(i)
-        self.spi_write(bytearray(tx_data))
+            tx[size] = i
+            size += 1
+        self.spi_send(size)
    
     def spi_read_cmd(self, cmd, rx_size):
-        tx_data = [cmd, 0x00]
-        for i in range (rx_size):
-            tx_data.append(0)
-        rx_data = bytearray(len(tx_data))
-        self.spi_read_write(bytearray(tx_data), rx_data)
-        return rx_data[2:]
+        self.spi_read_cmd_into(cmd, rx_size)
+        return bytes(self.frame_rx[rx_size + 2][2:])
     
     def spi_write_cmd(self, cmd, buf):
-        tx_data = [cmd]
+        tx = self.tx
+        tx[0] = cmd
+        size = 1
         for i in buf:
-            tx_data.append(i)
-#         print(tx_data)
-        self.spi_write(bytearray(tx_data))
+            tx[size] = i
+            size += 1
+        self.spi_send(size)
 
     def spi_read_buffer(self, index, size):
-        tx_data = [0x1E, index, 0x00]
-        for i in range (size):
-            tx_data.append(0)
-        rx_data = bytearray(len(tx_data))
-        self.spi_read_write(bytearray(tx_data), rx_data)
-        return rx_data[3:]
+        self.spi_read_buffer_into(index, size)
+        return bytes(self.rx_mv[3:3 + min(size, RX_MAX)])
+
+    def spi_read_buffer_into(self, index, size):
+        # the whole payload in one transaction, it lands at rx_buf[3:3 + size]
+        size = min(size, RX_MAX)
+        views = self.rx_views.get(size)
+        if views == None:
+            views = (self.rx_tx_mv[:3 + size], self.rx_mv[:3 + size])
+            self.rx_views[size] = views
+        self.rx_tx[1] = index & 0xFF
+        self.spi_read_write(views[0], views[1])
         
 #============================HARDWARE==========================
         
@@ -79,16 +199,28 @@ class Lora:
         time.sleep_ms(10)
         self.reset(1)
         time.sleep_ms(100)
-        return not self.check_busy()
-
-    def check_busy(self):
-        state = self.busy()
-        timeout = 10000
-        while state == 1:
-            state = self.busy()
-            if timeout == 0:
+        return not self.check_busy(BUSY_TIMEOUT_MS * 1000)
+
+    def check_busy(self, timeout_us=BUSY_BLOCK_US):
+        # True when BUSY is still high after timeout_us; blocks, see wait_busy()
+        if self.busy() == 0:
+            return False
+        start = time.ticks_us()
+        while self.busy() == 1:
+            if time.ticks_diff(time.ticks_us(), start) >= timeout_us:
                 return True
-            timeout -= 1
+        return False
+
+    async def wait_busy(self, timeout_ms=BUSY_TIMEOUT_MS):
+        # True when BUSY is still high after timeout_ms, other tasks run while it is awaited
+        if not self.check_busy(BUSY_SPIN_US):
+            return False
+        start = time.ticks_ms()
+        while self.busy() == 1:
+            if time.ticks_diff(time.ticks_ms(), start) >= timeout_ms:
+                return True
+            self.busy_yields += 1
+            await asyncio.sleep_ms(1)
         return False
     
     def rx_init(self):
@@ -109,13 +241,74 @@ class Lora:
         self.get_device_errors()
         self.clear_device_errors()
         self.clear_irq_status()
-        self.payload, self.index = self.get_rx_buffer_state()
+        # get_rx_buffer_state() without the tuple
+        rx = self.spi_read_cmd_into(0x13, 2)
+        self.payload = rx[2]
+        self.index = rx[3]
 #         print(self.payload, self.index)
 
+    def attach(self):
+        self.dio1.irq(trigger=Pin.IRQ_RISING, handler=self.isr)
+        if self.dio1() == 1:
+            self.flag.set()
+
+    def isr(self, pin):
+        # hard interrupt: no SPI and no allocation, only note the edge and wake the rx task
+        if self.irq_pending:
+            # DIO1 rose again before the last interrupt was served
+            self.overruns += 1
+        else:
+            self.irq_ticks = time.ticks_us()
+            self.irq_pending = True
+        self.irqs += 1
+        self.flag.set()
+
+    async def poll(self, period_s):
+        # wakes the rx task every period_s in case a DIO1 edge was missed
+        while True:
+            await asyncio.sleep(period_s)
+            self.flag.set()
+
+    def wait(self):
+        # the wakeup of the rx task, an interrupt or poll(); irq_pending tells which. A bare flag
+        # wait: no wait_for task, coroutine and TimeoutError on every pass
+        return self.flag.wait()
+
+    def service(self):
+        # runs in the rx task: reads and clears the radio interrupts and queues a received packet,
+        # True when there were any interrupts
+        self.rx_ticks = self.irq_ticks if self.irq_pending else time.ticks_us()
+        self.irq_pending = False
+        self.get_irq_status()
+        if self.irq_state == 0:
+            return False
+        self.callback()
+        if self.irq_state & (IRQ_RX_DONE | IRQ_HEADER_ERR):
+            self.enqueue()
+        if self.dio1() == 1:
+            # an interrupt came in after the clear, no edge will follow for it
+            self.flag.set()
+        return True
+
+    def enqueue(self):
+        # payload and GetPacketStatus into the queue; a header error has no payload
+        size = self.payload if self.irq_state & IRQ_RX_DONE else 0
+        if size:
+            self.spi_read_buffer_into(self.index, size)
+        rx = self.spi_read_cmd_into(0x14, 3)
+        snr = rx[3] - 256 if rx[3] > 127 else rx[3]
+        self.queue.push(self.rx_ticks, self.rx_buf, 3, size, rx[2] // -2, snr, rx[4] // -2, self.irq_state)
+        self.payload = 0
+
+    def stats(self):
+        return {"irqs": self.irqs, "overruns": self.overruns, "queue": self.queue.stats(),
+                "spiCommands": self.spi_count, "spiMaxUs": self.spi_max_us, "busyTimeouts": self.busy_timeouts,
+                "busyYields": self.busy_yields}
+
 #==========================LORA_SET==========================
 
     def set_standby(self, mode):
-        self.spi_write_cmd(0x80, [mode])
+        self.spi_write_cmd1(0x80, mode)
 
     def set_packet_type(self):
         self.spi_write_cmd(0x8A, [0x01])
@@ -132,7 +325,7 @@ class Lora:
         
     def set_rx_gain(self):
         gain = 0x94
-        self.spi_write_register(0x08AC, [gain])
+        self.spi_write_register1(0x08AC, gain)
 #         self.spi_write_register(0x029F, [0x01, 0x08, 0xAC])
 
     def set_lora_modulation(self):
@@ -178,8 +371,8 @@ class Lora:
     
     def set_xta_xtb_trim(self):
         trim = 0x1C
-        self.spi_write_register(0x0911, [0x1C])
-        self.spi_write_register(0x0912, [0x1C])
+        self.spi_write_register1(0x0911, trim)
+        self.spi_write_register1(0x0912, trim)
         
     def set_buffer_base_addr(self):
         tx = 0x00
@@ -188,7 +381,7 @@ class Lora:
         
     def set_ocp(self):
         ocp = 0x38
-        self.spi_write_register(0x08E7, [ocp])
+        self.spi_write_register1(0x08E7, ocp)
     
     def set_tx_params(self):
         buf = [20, 0x07]
@@ -197,43 +390,43 @@ class Lora:
 #==========================LORA_GET==========================
 
     def get_irq_status(self):
-        buf = self.spi_read_cmd(0x12, 2)
-        self.irq_state = buf[0] << 8 | buf[1]
+        rx = self.spi_read_cmd_into(0x12, 2)
+        self.irq_state = rx[2] << 8 | rx[3]
     
     def clear_irq_status(self):
-        self.spi_write_cmd(0x02, [0x03, 0xFF])
+        self.spi_write_cmd2(0x02, 0x03, 0xFF)
     
     def get_rx_buffer_state(self):
-        buf = self.spi_read_cmd(0x13, 2)
+        rx = self.spi_read_cmd_into(0x13, 2)
 #         print(buf)
-        return buf[0], buf[1]
+        return rx[2], rx[3]
 
     def get_mode(self):
-        buf = self.spi_read_cmd(0xC0, 1)
-        return buf[0] & 0x70
+        rx = self.spi_read_cmd_into(0xC0, 1)
+        return rx[2] & 0x70
     
     def get_rssi_and_snr(self):
         (self.rssi_pkg, self.snr_pkg, self.rssi_signal) = get_packet_status()
         return self.rssi_pkg, self.snr_pkg
     
     def get_packet_status(self):
-        buf = self.spi_read_cmd(0x14, 3)
-        return buf[0]
+        rx = self.spi_read_cmd_into(0x14, 3)
+        return rx[2]
 #         return buf[0:3]
     
     def get_device_errors(self):
-        buf = self.spi_read_cmd(0x17, 1)
-        return buf[0]
+        rx = self.spi_read_cmd_into(0x17, 1)
+        return rx[2]
     
     def clear_device_errors(self):
-        self.spi_write_cmd(0x07, [0x00, 0x00])
+        self.spi_write_cmd2(0x07, 0x00, 0x00)
 
 #==========================LORA_LOGIC==========================
 
     def begin(self):
         self.reset_lora()
         self.cs(0)
-        if self.check_busy():
+        if self.check_busy(BUSY_TIMEOUT_MS * 1000):
             return False
         self.set_standby(0x00)
         if self.get_mode() != 0x20:
@@ -243,6 +436,8 @@ class Lora:
         self.set_dio3_tcxo_ctrl()
         self.set_regulator_mode()
         self.set_standby(0x01)
+        # the TCXO starts, longer than a command may block
+        self.check_busy(BUSY_TIMEOUT_MS * 1000)
         self.set_xta_xtb_trim()
         if self.get_mode() != 0x30:
             print('TXCO start problem')
@@ -260,6 +455,7 @@ class Lora:
 
     def request(self):
         self.set_standby(0x01)
+        self.check_busy(BUSY_TIMEOUT_MS * 1000)
         self.set_xta_xtb_trim()
         if self.get_mode() == 0x50 : return False
         self.set_irq(0x0002 | 0x0200 | 0x0020 | 0x0040)
@@ -272,16 +468,12 @@ class Lora:
         return self.payload
 
     def read(self):
-        a = []
-        for i in range(0, self.payload):
-            buf = (self.spi_read_buffer((self.index+i), 1))
-            a.append(buf)
-#             print(f' --> 0x{hexlify(buf).decode().upper()}')
-#         self.index = self.index + self.payload
+        self.spi_read_buffer_into(self.index, self.payload)
         self.index = self.index + self.payload
         self.payload = 0
-        return hexlify(a[0]+a[1]+a[2]+a[3]).decode().lower(), a[4][0], a[5][0]
-        #return buf.hex()
+        buf = self.rx_buf
+        uid = buf[3] << 24 | buf[4] << 16 | buf[5] << 8 | buf[6]
+        return uid, buf[7], buf[8]
     
     def get_status(self):
         irq_state = self.irq_state
@@ -296,23 +488,19 @@ class Lora:
 #============================FIXES==========================
         
     def fix_antenna(self):
-        buf = self.spi_read_register(0x0902, 1)
-        value = buf[0] | 0x1E
-        self.spi_write_register(0x0902, [value])
+        value = self.spi_read_register1(0x0902) | 0x1E
+        self.spi_write_register1(0x0902, value)
     
     def fix_inverted_iq(self):
-        buf = self.spi_read_register(0x0736, 1)
-        value = buf[0] & 0xFB
-        self.spi_write_register(0x0736, [value])
+        value = self.spi_read_register1(0x0736) & 0xFB
+        self.spi_write_register1(0x0736, value)
         
     def fix_rx_timeout(self):
-        self.spi_write_register(0x0902, [0])
-        buf = self.spi_read_register(0x0944, 1)
-        value = buf[0] | 0x02
-        self.spi_write_register(0x0944, [value])
+        self.spi_write_register1(0x0902, 0)
+        value = self.spi_read_register1(0x0944) | 0x02
+        self.spi_write_register1(0x0944, value)
 
     def fix_tx_modulation(self):
-        buf = self.spi_read_register(0x0889, 1)
-        value = buf[0] | 0x04
-        self.spi_write_register(0x0889, [value])
+        value = self.spi_read_register1(0x0889) | 0x04
+        self.spi_write_register1(0x0889, value)
         
\ No newline at end of file
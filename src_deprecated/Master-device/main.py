@@ -5,17 +5,42 @@ import ubinascii
 import ujson
 
 from pkg import MasterDevice
+from telemetry import DeltaTelemetry
+from scheduler import Scheduler
+from outputs import OutputDriver
+from spool import Spool
+from app import App
 from LoRa import Lora
 from machine import SPI, Pin
 from micropython import const
 from machine import UART, Pin
 from network import WLAN, STA_IF
-from lib.gsm.SIM800x import SIM800x
+from lib.gsm.SIM800x import SIM800x, GSMError
 from lib.umqtt.client import MQTTClient, Logger
 from lib.pixel import Indicate
 
+OUTPUT_PINS = (42, 41, 40, 39)
+# valves open at once, more of them drop the line pressure; FLOW_BUDGET limits the summed schedule "flow" instead.
+# None is unlimited, every site sets the limits of its own line
+MAX_ACTIVE_OUTPUTS = None
+FLOW_BUDGET = None
+# publish changed fields to '<uuid>/delta' with a full keyframe every DELTA_KEYFRAME_EVERY messages
+DELTA_TELEMETRY = False
+DELTA_KEYFRAME_EVERY = const(16)
+# while MQTT is down the device keeps running, reconnects every RECONNECT_S and reboots after OFFLINE_REBOOT_S
+RECONNECT_S = const(60)
+OFFLINE_REBOOT_S = const(3600)
+# a PPP link that is not up again within PPP_TIMEOUT_S is retried at the next reconnect
+PPP_TIMEOUT_S = const(60)
+# LoRa packets are read on the DIO1 interrupt, the radio is also polled this often
+LORA_POLL_S = const(10)
+
 led = Indicate()
-master = MasterDevice()
+master = MasterDevice(outputs=len(OUTPUT_PINS), max_active=MAX_ACTIVE_OUTPUTS, flow_budget=FLOW_BUDGET)
+telemetry = DeltaTelemetry(master, DELTA_KEYFRAME_EVERY) if DELTA_TELEMETRY else None
+scheduler = Scheduler(master)
+spool = Spool()
+app = App(master, telemetry, spool)
 period_time = const(10)
 
 global master
@@ -61,83 +86,58 @@ def on_mqtt_publish_received(event: str, **kwargs):
     _client: MQTTClient = kwargs.get('mqtt_client')
     _topic: str = kwargs.get('topic')
     _payload: bytes = kwargs.get('payload')
-    global master
-    topic_callback(master, _topic, _payload)
+    app.dispatch(_topic, _payload)
     led.green_pixel()
     print(f'MQTT received topic: "{_topic}", payload: {_payload}')
 
-    if _topic.endswith('/req') and _payload.decode('utf8') == 'reboot':
-        _client.publish(topic='status', payload='0', retain=True)
-        _client.disconnect()
-
 def on_sim800_event(event: str, **kwargs):
     print(f'SIM800 event: "{event}", {kwargs}')
 
-def topic_callback(master, topic: str, payload: bytes):
-    if topic == 'service/time/utc':
-        master.lastTs = int(payload.decode('utf8'))
-    if topic == f'FF09/{master.uuid}/req' and payload == b'true':
-        master.req = True
-    if topic == f'FF09/{master.uuid}/updated':
-        payload = ujson.loads(payload.decode('utf8').replace("'", '"'))
-        master.update(payload)
-    if topic == f'FF09/{master.uuid}/add-wireless-sensor':
-        payload = ujson.loads(payload.decode('utf8').replace("'", '"'))
-        master.add_lora(payload.get("name"), payload.get("uid"))
-    if topic == f'FF09/{master.uuid}/remove-wireless-sensor':
-        payload = ujson.loads(payload.decode('utf8').replace("'", '"'))
-        master.delete_lora(payload.get("uid"))
-        
-async def publish_pkg(master, mqtt, period_s):
-    while True:
-        mqtt.publish(topic=master.uuid, payload=master.convert_to_pkg(), retain=False)
-        await asyncio.sleep(period_s)
-
-async def lora_pkg(master, lora, period_s):
-    while True:
-        if lora.available() != 0:
-            uid, hum, bat = lora.read()
-            rssi = (lora.get_packet_status())// (-2)
-            status = lora.get_status()
-            if status != 9 or status != 8:
-                print(f'LoRa packet receive: {uid}, {hum}, {bat}, {rssi}')
-                master.lora_data(uid, hum, bat, rssi)
-            else:
-                print('LoRa packet error!')
-        lora.get_irq_status()
-        if lora.irq_state != 0:
-            lora.callback()
-        await asyncio.sleep(period_s)
-
-async def check_outputs_value(master, period_s):
-    while True:
-        master.check_outputs_val()
-        await asyncio.sleep(period_s)
-
-async def check_schedule_value(master, period_s):
+async def lora_pkg(lora, poll_s):
+    # woken by the DIO1 interrupt, the radio is polled every poll_s only in case an edge was missed.
+    # Packets go to lora.queue, master.lora_rx applies them. An interrupt that finds the radio
+    # busy is not dropped: the flag is set again and the next pass serves it.
+    lora.attach()
+    asyncio.create_task(lora.poll(poll_s))
     while True:
-        master.check_outputs_sch()
-        await asyncio.sleep(period_s)
+        await lora.wait()
+        if await lora.wait_busy():
+            print('LoRa busy timeout!')
+            if lora.irq_pending:
+                lora.flag.set()
+            continue
+        lora.service()
+
+async def ppp_reconnect(sim800):
+    # after a GPRS drop the PPP link is down as well, MQTT needs a new one first
+    if sim800.is_ppp_connected:
+        return
+    try:
+        await sim800.ppp_disconnect()
+        await asyncio.wait_for(sim800.ppp_connect(), PPP_TIMEOUT_S)
+    except (asyncio.TimeoutError, OSError, GSMError, AssertionError) as e:
+        print(f'PPP reconnect failed: {e}')
 
-async def check_api(master, mqtt, period_s):
-    while True:
-        if master.req == True:   
-            mqtt.publish(topic=master.uuid, payload=master.convert_to_pkg(), retain=False)
-            mqtt.publish(topic=f'{master.uuid}/req', payload = b'false', retain=False)
-            master.req = False
-        await asyncio.sleep(period_s)
+async def mqtt_connect(mqtt):
+    try:
+        await asyncio.wait_for(mqtt.connect(
+            host='t1.bast-dev.ru',
+            keepalive_period=60,
+             client_id='device::FF09',
+        ), 30)
+    except (asyncio.TimeoutError, OSError) as e:
+        print(f'MQTT connect failed: {e}')
+        return
+    if not mqtt.is_connected:
+        return
+
+    app.subscribe(mqtt, mqtt.client_id.lstrip('device::'))
 
 async def start():
     await asyncio.sleep(1)
 
-    master.output1.out = Pin(42, Pin.OUT, Pin.PULL_DOWN)
-    master.output1.out(0)
-    master.output2.out = Pin(41, Pin.OUT, Pin.PULL_DOWN)
-    master.output2.out(0)
-    master.output3.out = Pin(40, Pin.OUT, Pin.PULL_DOWN)
-    master.output3.out(0)
-    master.output4.out = Pin(39, Pin.OUT, Pin.PULL_DOWN)
-    master.output4.out(0)
+    master.driver = OutputDriver(OUTPUT_PINS)
+    master.drive_outputs()
     
     #wlan = connect() #for Wi-Fi connect
     sim800 = SIM800x(UART(2, 115200, rx=17, tx=18), log_level=Logger.WARNING)
@@ -156,6 +156,7 @@ async def start():
     spi.init()
     
     lora = Lora(spi, cs, reset, busy, dio1, txen, rxen)
+    app.lora = lora
 
     for _event in SIM800x.EVENTS_LIST:
         sim800.append_callback(_event, on_sim800_event)
@@ -169,19 +170,7 @@ async def start():
     mqtt.append_callback(MQTTClient.EVENT_SUBSCRIBED, on_mqtt_subscribed)
     mqtt.append_callback(MQTTClient.EVENT_PUBLISH_RECEIVED, on_mqtt_publish_received)
 
-    await mqtt.connect(
-        host='t1.bast-dev.ru',
-        keepalive_period=60,
-         client_id='device::FF09',
-    )
-
-    _prefix = mqtt.client_id.lstrip('device::')
-    mqtt.subscribe(topic=_prefix + '/api/+/req/#')
-    mqtt.subscribe(topic='service/time/utc')
-    mqtt.subscribe(topic=f'FF09/{master.uuid}/req')
-    mqtt.subscribe(topic=f'FF09/{master.uuid}/updated')
-    mqtt.subscribe(topic=f'FF09/{master.uuid}/add-wireless-sensor')
-    mqtt.subscribe(topic=f'FF09/{master.uuid}/remove-wireless-sensor')
+    await mqtt_connect(mqtt)
     
     mqtt.publish(topic=f'{master.uuid}/status',payload='1', retain=True)
   
@@ -190,28 +179,46 @@ async def start():
     lora.set_frequency()
     lora.set_rx_gain()
 
-    dio1.irq(trigger=Pin.IRQ_RISING, handler=lora.callback())
-    dio1.irq
-    
     lora.set_lora_modulation()
     lora.set_sync_word()
     lora.set_lora_packet()
 
     lora.request()
 
-    asyncio.create_task(publish_pkg(master, mqtt, 900))
-    asyncio.create_task(check_api(master, mqtt, 1))
-    asyncio.create_task(lora_pkg(master, lora, 1))
-    asyncio.create_task(check_outputs_value(master, 2))
-    asyncio.create_task(check_schedule_value(master, 2))
+    def on_lora_packet(uid, hum, bat, rssi):
+        print(f'LoRa packet receive: {uid:08x}, {hum}, {bat}, {rssi}')
+        app.spool_sample(mqtt, uid, hum, bat, rssi)
+
+    asyncio.create_task(master.store.run(master))
+    asyncio.create_task(app.publish_pkg(mqtt, 900))
+    asyncio.create_task(app.check_api(mqtt, 1))
+    asyncio.create_task(lora_pkg(lora, LORA_POLL_S))
+    asyncio.create_task(master.lora_rx(lora.queue, on_lora_packet))
+    asyncio.create_task(scheduler.run())
+    asyncio.create_task(spool.drain(mqtt))
     
     led.green_pixel()
     
     try:
-        while mqtt.is_connected:
+        offline_s = 0
+        while not app.reboot_req and offline_s < OFFLINE_REBOOT_S:
             await asyncio.sleep(1)
-
+            if mqtt.is_connected:
+                offline_s = 0
+                continue
+            offline_s += 1
+            if offline_s % RECONNECT_S == 0:
+                await ppp_reconnect(sim800)
+                await mqtt_connect(mqtt)
+                if mqtt.is_connected:
+                    mqtt.publish(topic=f'{master.uuid}/status', payload='1', retain=True)
+
+        if mqtt.is_connected:
+            mqtt.publish(topic='status', payload='0', retain=True)
+            mqtt.disconnect()
         await sim800.ppp_disconnect()
+        master.store.flush(master)
+        spool.save_cursor()
 
         print('ESP will be rebooted...')
         await asyncio.sleep(5)
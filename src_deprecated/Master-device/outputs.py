@@ -0,0 +1,65 @@
+import time
+import machine
+
+from machine import Pin
+from micropython import const
+
+# ESP32-S3 GPIO write-1-to-set / write-1-to-clear registers, bank 0 is GPIO0..31, bank 1 GPIO32..48
+_W1TS = (const(0x60004008), const(0x60004014))
+_W1TC = (const(0x6000400C), const(0x60004018))
+
+
+class OutputDriver:
+    # Shadow of the commanded output levels, bit n is output slot n. write() only touches the
+    # hardware when the state changed, and all changed pins of a bank switch in one register write.
+    def __init__(self, pins, port_write=True):
+        self.pins = [Pin(pin, Pin.OUT, Pin.PULL_DOWN) for pin in pins]
+        self.gpio = pins
+        self.port_write = port_write and hasattr(machine, 'mem32')
+        self.shadow = 0
+
+        self.requests = 0
+        self.writes = 0
+        self.transitions = 0
+        self.last_write_us = 0
+
+        for pin in self.pins:
+            pin(0)
+
+    def _port(self, changed, state):
+        # slot mask -> set/clear masks of both GPIO banks
+        masks = [0, 0, 0, 0]
+        for slot, gpio in enumerate(self.gpio):
+            if changed & (1 << slot):
+                masks[(gpio >> 5) * 2 + (0 if state & (1 << slot) else 1)] |= 1 << (gpio & 31)
+        for bank in (0, 1):
+            if masks[bank * 2]:
+                machine.mem32[_W1TS[bank]] = masks[bank * 2]
+            if masks[bank * 2 + 1]:
+                machine.mem32[_W1TC[bank]] = masks[bank * 2 + 1]
+
+    def write(self, state):
+        self.requests += 1
+        changed = self.shadow ^ state
+        if not changed:
+            return
+        start = time.ticks_us()
+        if self.port_write:
+            self._port(changed, state)
+        else:
+            for slot, pin in enumerate(self.pins):
+                if changed & (1 << slot):
+                    pin(1 if state & (1 << slot) else 0)
+        self.last_write_us = time.ticks_diff(time.ticks_us(), start)
+        self.shadow = state
+        self.writes += 1
+        while changed:
+            self.transitions += changed & 1
+            changed >>= 1
+
+    def level(self, slot):
+        return 1 if self.shadow & (1 << slot) else 0
+
+    def stats(self):
+        return {"requests": self.requests, "writes": self.writes, "transitions": self.transitions,
+                "lastWriteUs": self.last_write_us, "state": self.shadow}
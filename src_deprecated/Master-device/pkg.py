@@ -5,9 +5,50 @@ import machine
 
 from machine import Pin
 from micropython import const
+from store import StateStore
+from clock import Clock
+from calendars import Calendar
+from history import History
+from filters import HumidityFilter
+from snapshot import EXTRAS_ROOM, Snapshot, encode, is_snapshot, size as snapshot_size
+
+LORA_CHANNELS = const(4)
+SENSOR_CHANNELS = const(4)
+OUTPUT_CHANNELS = const(4)
+
+def uid_key(uid):
+    # wireless sensor uids are 4 raw bytes: the radio hands them over as int, the API as a hex string
+    if uid == None or isinstance(uid, int):
+        return uid
+    try:
+        return int(uid, 16)
+    except (TypeError, ValueError):
+        return None
+
+SECTION_DEVICE = 'device'
+SECTION_LORAS = 'wirelessSensors'
+SECTION_SENSORS = 'sensors'
+SECTION_OUTPUTS = 'outputs'
+
+class ChannelPkg:
+    # _json caches the serialized record until the next touch()
+    __slots__ = ('_json',)
+
+    def touch(self):
+        self._json = None
+
+    def json(self):
+        if self._json == None:
+            self._json = ujson.dumps(self.to_dict())
+        return self._json
+
+class LoraPkg(ChannelPkg):
+    __slots__ = ('name', 'uid', 'value', 'rssi', 'lastTs', 'batteryLevel', 'humidity')
 
-class LoraPkg:
     def __init__(self):
+        self.clear()
+
+    def clear(self):
         self.name = None
         self.uid = None
         self.value = None
@@ -15,29 +56,115 @@ class LoraPkg:
         self.lastTs = None
         self.batteryLevel = None
         self.humidity = None
+        self.touch()
+
+    def load(self, data):
+        self.name = data.get("name")
+        self.uid = data.get("uid")
+        self.value = data.get("value")
+        self.rssi = data.get("rssi")
+        self.lastTs = data.get("lastTs")
+        self.batteryLevel = data.get("batteryLevel")
+        self.humidity = data.get("humidity")
+        self.touch()
+
+    def to_dict(self):
+        return {"rssi": self.rssi, "name": self.name, "lastTs": self.lastTs,
+                "uid": self.uid, "batteryLevel": self.batteryLevel, "humidity": self.humidity}
+
+class SensorPkg(ChannelPkg):
+    __slots__ = ('type', 'uuid', 'value', 'lastTs')
 
-class SensorPkg:
     def __init__(self):
+        self.clear()
+
+    def clear(self):
         self.type = None
         self.uuid = None
         self.value = None
         self.lastTs = None
+        self.touch()
+
+    def load(self, data):
+        self.type = data.get("type")
+        self.uuid = data.get("uuid")
+        self.value = data.get("value")
+        self.lastTs = data.get("lastTs")
+        self.touch()
+
+    def to_dict(self):
+        return {"type": self.type, "uuid": self.uuid, "value": self.value, "lastTs": self.lastTs}
+
+class OutputPkg(ChannelPkg):
+    __slots__ = ('name', 'id', 'uuidWirelessSensor', 'sensor', 'value', 'lastTs', 'schedule', 'calendar', 'filter',
+                 'flow', 'ontime', 'hum_endTs', 'waiting', 'deferred')
 
-class OutputPkg:
     def __init__(self):
+        self.clear()
+
+    def clear(self):
         self.name = None
         self.id = None
-        self.uuidWirelessSensor = None
+        self.bind(None)
         self.value = None
         self.lastTs = None
         self.schedule = {'startTs': None, 'endTs': None}
+        self.calendar = None
+        self.filter = HumidityFilter()
+        self.flow = 1
         self.ontime = False
         self.hum_endTs = None
+        # since when the start waits for the site budget, and for how long the running window waited
+        self.waiting = None
+        self.deferred = 0
+        self.touch()
+
+    def load(self, data):
+        self.name = data.get("name")
+        self.id = data.get("id")
+        self.bind(data.get("uuidWirelessSensor"))
+        self.value = data.get("value")
+        self.lastTs = data.get("lastTs")
+        self.set_schedule(data.get("schedule"))
+        self.touch()
+
+    def bind(self, uuid):
+        # sensor is the uid key of the bound sensor, compared with every packet the radio hands over
+        self.uuidWirelessSensor = uuid
+        self.sensor = uid_key(uuid)
+
+    def set_schedule(self, schedule):
+        # a schedule with "windows" is compiled once into a Calendar, see calendars.py
+        self.schedule = schedule
+        self.waiting = None
+        try:
+            self.calendar = Calendar.from_schedule(schedule)
+        except (TypeError, ValueError, KeyError):
+            self.calendar = None
+        # the filter keeps its readings while its settings stay the same
+        config = schedule.get("filter") if schedule != None else None
+        if config != self.filter.config:
+            try:
+                self.filter = HumidityFilter.from_config(config)
+            except (TypeError, ValueError, AttributeError):
+                self.filter = HumidityFilter()
+        # share of the site flow budget, a missing or bad "flow" counts as 1
+        flow = schedule.get("flow", 1) if schedule != None else 1
+        if isinstance(flow, bool) or not isinstance(flow, (int, float)) or not flow > 0:
+            flow = 1
+        self.flow = flow
+
+    def to_dict(self):
+        return {"name": self.name, "value": self.value, "lastTs": self.lastTs, "id": self.id,
+                "uuidWirelessSensor": self.uuidWirelessSensor, "schedule": self.schedule}
 
 class MasterDevice:
-    def __init__(self):
+    def __init__(self, loras=LORA_CHANNELS, sensors=SENSOR_CHANNELS, outputs=OUTPUT_CHANNELS, store=None, clock=None,
+                 max_active=None, flow_budget=None):
         self.uuid = ubinascii.hexlify(machine.unique_id()).decode('utf-8')
+        # last 'service/time/utc' broadcast, the current time comes from now()
         self.lastTs = None
+        self.clock = clock if clock != None else Clock()
         self.req = False
         self.push = False
         self.save = False
@@ -46,483 +173,516 @@ class MasterDevice:
         self.humidity = None
         self.temperature = None
 
-        self.lora1 = LoraPkg()
-        self.lora2 = LoraPkg()
-        self.lora3 = LoraPkg()
-        self.lora4 = LoraPkg()
-
-        self.sensor1 = SensorPkg()
-        self.sensor2 = SensorPkg()
-        self.sensor3 = SensorPkg()
-        self.sensor4 = SensorPkg()
-
-        self.output1 = OutputPkg()
-        self.output1.out = None
-        self.output2 = OutputPkg()
-        self.output2.out = None
-        self.output3 = OutputPkg()
-        self.output3.out = None
-        self.output4 = OutputPkg()
-        self.output4.out = None
+        # Fixed-capacity channel tables, allocated once: a free channel is a record with uid/type/name None
+        self.loras = [LoraPkg() for _ in range(loras)]
+        self.sensors = [SensorPkg() for _ in range(sensors)]
+        self.outputs = [OutputPkg() for _ in range(outputs)]
+        # uid (int) -> index in self.loras
+        self.lora_index = {}
+        # reading history of every LoRa channel, kept in RAM only
+        self.histories = [History() for _ in range(loras)]
+        # event-driven scheduler of the outputs, see scheduler.Scheduler
+        self.scheduler = None
+        # shadow register of the output pins, see outputs.OutputDriver
+        self.driver = None
+        # site hydraulics: outputs open at once and the sum of their "flow", None is unlimited
+        self.max_active = max_active
+        self.flow_budget = flow_budget
+        # serialized sections and the whole document, None when dirty
+        self.sections = {SECTION_DEVICE: None, SECTION_LORAS: None, SECTION_SENSORS: None, SECTION_OUTPUTS: None}
+        self.pkg = None
+        # the state is written behind by the store task, see StateStore.run
+        self.store = store if store != None else StateStore()
+        # binary snapshot buffer, shared by boot load and compaction
+        self.snapshot_buf = bytearray(snapshot_size(loras, sensors, outputs) + outputs * EXTRAS_ROOM)
 
         self.default_pkg = {"rssi": None, "humidity": None, "temperature": None,
                             "sensors": [{"type": None, "uuid": None, "value": None, "lastTs": None}],
                             "outputs": [
-                                {"name": "output 1", "value": None, "lastTs": None, "id": 1, "uuidWirelessSensor": None,
-                                 "schedule": {"startTs": None, "endTs": None}},
-                                {"name": "output 2", "value": None, "lastTs": None, "id": 2, "uuidWirelessSensor": None,
-                                 "schedule": {"startTs": None, "endTs": None}},
-                                {"name": "output 3", "value": None, "lastTs": None, "id": 3, "uuidWirelessSensor": None,
-                                 "schedule": {"startTs": None, "endTs": None}},
-                                {"name": "output 4", "value": None, "lastTs": None, "id": 4, "uuidWirelessSensor": None,
-                                 "schedule": {"startTs": None, "endTs": None}}],
+                                {"name": f"output {i}", "value": None, "lastTs": None, "id": i, "uuidWirelessSensor": None,
+                                 "schedule": {"startTs": None, "endTs": None}} for i in range(1, outputs + 1)],
                             "wirelessSensors": [
                                 {"rssi": None, "name": None, "lastTs": None, "uid": None, "batteryLevel": None,
                                  "humidity": None}]}
 
         self.check_last()
 
+    def touch(self, section, record=None, critical=False):
+        # critical changes (configuration, schedule) are persisted quickly, readings are debounced
+        if record != None:
+            record.touch()
+        self.sections[section] = None
+        self.pkg = None
+        self.store.mark(critical)
+
+    def touch_all(self):
+        for section in self.sections:
+            self.sections[section] = None
+        self.pkg = None
+
+    def reindex_loras(self):
+        self.lora_index = {}
+        for slot, lora in enumerate(self.loras):
+            key = uid_key(lora.uid)
+            if key != None and key not in self.lora_index:
+                self.lora_index[key] = slot
+
+    def find_lora(self, uid):
+        slot = self.lora_index.get(uid_key(uid))
+        if slot == None:
+            return None
+        return self.loras[slot]
+
+    def now(self):
+        return self.clock.now()
+
+    def sync_time(self, utc):
+        self.lastTs = utc
+        if self.clock.sync(utc):
+            self.replan()
+
+    def find_output(self, id):
+        for output in self.outputs:
+            if output.id == id:
+                return output
+        return None
+
     def lora_data(self, uid, hum, bat, rssi):
-        if uid == self.lora1.uid:
-            self.lora1.lastTs = self.lastTs
-            self.lora1.humidity = hum
-            self.lora1.batteryLevel = bat
-            self.lora1.rssi = rssi
-        elif uid == self.lora2.uid:
-            self.lora2.lastTs = self.lastTs
-            self.lora2.humidity = hum
-            self.lora2.batteryLevel = bat
-            self.lora2.rssi = rssi
-        elif uid == self.lora3.uid:
-            self.lora3.lastTs = self.lastTs
-            self.lora3.humidity = hum
-            self.lora3.batteryLevel = bat
-            self.lora3.rssi = rssi
-        elif uid == self.lora4.uid:
-            self.lora4.lastTs = self.lastTs
-            self.lora4.humidity = hum
-            self.lora4.batteryLevel = bat
-            self.lora4.rssi = rssi
+        slot = self.lora_index.get(uid)
+        if slot != None:
+            lora = self.loras[slot]
+            lora.lastTs = self.now()
+            lora.humidity = hum
+            lora.batteryLevel = bat
+            lora.rssi = rssi
+            self.touch(SECTION_LORAS, lora)
+            if lora.lastTs != None:
+                self.histories[slot].add(lora.lastTs, int(hum), int(bat), int(rssi))
+            # a running output bound to this sensor gets its end time from the new humidity
+            for output in self.outputs:
+                if output.sensor == uid:
+                    output.filter.add(lora.lastTs, hum)
+                    if output.ontime == True:
+                        schedule = output.schedule
+                        output.hum_endTs = self.hum_out_math(output, schedule.get("startTs"), schedule.get("endTs")) \
+                            + output.deferred
+                        self.replan()
+
+    async def lora_rx(self, queue, on_packet=None):
+        # applies the packets queued by the LoRa rx task (rxqueue.RxQueue), then on_packet(uid, hum, bat, rssi)
+        while True:
+            await queue.wait()
+            slot = queue.pop()
+            while slot >= 0:
+                packet = queue.sensor(slot)
+                if packet != None:
+                    uid, hum, bat = packet
+                    rssi = queue.rssi[slot]
+                    self.lora_data(uid, hum, bat, rssi)
+                    if on_packet != None:
+                        on_packet(uid, hum, bat, rssi)
+                slot = queue.pop()
 
     def update_last(self, data):
         self.rssi = data.get("rssi")
         self.humidity = data.get("humidity")
         self.temperature = data.get("temperature")
 
-        temp = data.get("wirelessSensors")
-        if temp != None:
-            try:
-                lora = temp[0]
-                self.lora1.name = lora.get("name")
-                self.lora1.uid = lora.get("uid")
-                self.lora1.value = lora.get("value")
-                self.lora1.rssi = lora.get("rssi")
-                self.lora1.lastTs = lora.get("lastTs")
-                self.lora1.batteryLevel = lora.get("batteryLevel")
-                self.lora1.humidity = lora.get("humidity")
-            except:
-                self.lora1 = LoraPkg()
-            try:
-                lora = temp[1]
-                self.lora2.name = lora.get("name")
-                self.lora2.uid = lora.get("uid")
-                self.lora2.value = lora.get("value")
-                self.lora2.rssi = lora.get("rssi")
-                self.lora2.lastTs = lora.get("lastTs")
-                self.lora2.batteryLevel = lora.get("batteryLevel")
-                self.lora2.humidity = lora.get("humidity")
-            except:
-                self.lora2 = LoraPkg()
-            try:
-                lora = temp[2]
-                self.lora3.name = lora.get("name")
-                self.lora3.uid = lora.get("uid")
-                self.lora3.value = lora.get("value")
-                self.lora3.rssi = lora.get("rssi")
-                self.lora3.lastTs = lora.get("lastTs")
-                self.lora3.batteryLevel = lora.get("batteryLevel")
-                self.lora3.humidity = lora.get("humidity")
-            except:
-                self.lora3 = LoraPkg()
-            try:
-                lora = temp[3]
-                self.lora4.name = lora.get("name")
-                self.lora4.uid = lora.get("uid")
-                self.lora4.value = lora.get("value")
-                self.lora4.rssi = lora.get("rssi")
-                self.lora4.lastTs = lora.get("lastTs")
-                self.lora4.batteryLevel = lora.get("batteryLevel")
-                self.lora4.humidity = lora.get("humidity")
-            except:
-                self.lora4 = LoraPkg()
-
-        temp = data.get("outputs")
-        if temp != None:
-            try:
-                output = temp[0]
-                self.output1.name = output.get("name")
-                self.output1.id = output.get("id")
-                self.output1.uuidWirelessSensor = output.get("uuidWirelessSensor")
-                self.output1.value = output.get("value")
-                self.output1.lastTs = output.get("lastTs")
-                self.output1.schedule = output.get("schedule")
-            except:
-                self.output1 = OutputPkg()
-            try:
-                output = temp[1]
-                self.output2.name = output.get("name")
-                self.output2.id = output.get("id")
-                self.output2.uuidWirelessSensor = output.get("uuidWirelessSensor")
-                self.output2.value = output.get("value")
-                self.output2.lastTs = output.get("lastTs")
-                self.output2.schedule = output.get("schedule")
-            except:
-                self.output2 = OutputPkg()
-            try:
-                output = temp[2]
-                self.output3.name = output.get("name")
-                self.output3.id = output.get("id")
-                self.output3.uuidWirelessSensor = output.get("uuidWirelessSensor")
-                self.output3.value = output.get("value")
-                self.output3.lastTs = output.get("lastTs")
-                self.output3.schedule = output.get("schedule")
-            except:
-                self.output3 = OutputPkg()
-            try:
-                output = temp[3]
-                self.output4.name = output.get("name")
-                self.output4.id = output.get("id")
-                self.output4.uuidWirelessSensor = output.get("uuidWirelessSensor")
-                self.output4.value = output.get("value")
-                self.output4.lastTs = output.get("lastTs")
-                self.output4.schedule = output.get("schedule")
-            except:
-                self.output4 = OutputPkg()
-
-        temp = data.get("sensors")
-        if temp != None:
-            try:
-                sensor = temp[0]
-                self.sensor1.type = sensor.get("type")
-                self.sensor1.uuid = sensor.get("uuid")
-                self.sensor1.value = sensor.get("value")
-                self.sensor1.lastTs = sensor.get("lastTs")
-            except:
-                self.sensor1 = SensorPkg()
-            try:
-                sensor = temp[1]
-                self.sensor2.type = sensor.get("type")
-                self.sensor2.uuid = sensor.get("uuid")
-                self.sensor2.value = sensor.get("value")
-                self.sensor2.lastTs = sensor.get("lastTs")
-            except:
-                self.sensor2 = SensorPkg()
-            try:
-                sensor = temp[2]
-                self.sensor3.type = sensor.get("type")
-                self.sensor3.uuid = sensor.get("uuid")
-                self.sensor3.value = sensor.get("value")
-                self.sensor3.lastTs = sensor.get("lastTs")
-            except:
-                self.sensor3 = SensorPkg()
-            try:
-                sensor = temp[3]
-                self.sensor4.type = sensor.get("type")
-                self.sensor4.uuid = sensor.get("uuid")
-                self.sensor4.value = sensor.get("value")
-                self.sensor4.lastTs = sensor.get("lastTs")
-            except:
-                self.sensor4 = SensorPkg()
+        for key, table in (("wirelessSensors", self.loras), ("outputs", self.outputs), ("sensors", self.sensors)):
+            temp = data.get(key)
+            if temp != None:
+                for i, item in enumerate(table):
+                    try:
+                        item.load(temp[i])
+                    except:
+                        item.clear()
+        self.reindex_loras()
+        self.touch_all()
 
     def check_last(self):
         try:
-            with open("data.json", "r", encoding='utf-8') as f:
-                data = f.read()
-                self.update_last(ujson.loads(data))
+            data = self.store.load(self.snapshot_buf)
+            if is_snapshot(data):
+                self.load_snapshot(Snapshot(data))
+            else:
+                self.update_last(ujson.loads(bytes(data)))
         except:
-            with open("data.json", "w", encoding='utf-8') as f:
-                ujson.dump(self.default_pkg, f)
-                self.update_last(self.default_pkg)
+            data = ujson.dumps(self.default_pkg).encode()
+            self.store.save(data)
+            self.update_last(self.default_pkg)
+        try:
+            for section, slot, record in self.store.replay(data):
+                self.apply_record(section, slot, ujson.loads(bytes(record)))
+        except:
+            self.store.request_compaction()
+        self.reindex_loras()
+        self.seed_filters()
+        self.touch_all()
+        self.store.track(self)
+
+    def load_snapshot(self, snap):
+        device = snap.device()
+        self.rssi = device.get("rssi")
+        self.humidity = device.get("humidity")
+        self.temperature = device.get("temperature")
+        for table, count, decode in ((self.loras, snap.loras, snap.lora), (self.sensors, snap.sensors, snap.sensor),
+                                     (self.outputs, snap.outputs, snap.output)):
+            for slot, record in enumerate(table):
+                data = decode(slot) if slot < count else None
+                if data != None:
+                    record.load(data)
+                else:
+                    record.clear()
+
+    def snapshot(self):
+        # binary state for flash, the JSON document when a field does not fit the fixed layout
+        try:
+            return memoryview(self.snapshot_buf)[:encode(self, self.snapshot_buf)]
+        except Exception:
+            return self.snapshot_json()
+
+    def snapshot_json(self):
+        # unlike convert_to_pkg every channel keeps its slot, null when free: the journal is replayed by slot
+        tables = ['[' + ', '.join([record.json() if getattr(record, used) != None else 'null' for record in table]) + ']'
+                  for table, used in ((self.loras, 'uid'), (self.sensors, 'type'), (self.outputs, 'name'))]
+        return ('{%s, "wirelessSensors": %s, "sensors": %s, "outputs": %s}' % (
+            self.section_json(SECTION_DEVICE), tables[0], tables[1], tables[2])).encode()
+
+    def journal_records(self):
+        # (section code, slot, record json), codes: 0 device, 1 wirelessSensors, 2 sensors, 3 outputs
+        yield 0, 0, '{' + self.section_json(SECTION_DEVICE) + '}'
+        for section, table in ((1, self.loras), (2, self.sensors), (3, self.outputs)):
+            for slot, record in enumerate(table):
+                yield section, slot, record.json()
+
+    def apply_record(self, section, slot, data):
+        if section == 0:
+            self.rssi = data.get("rssi")
+            self.humidity = data.get("humidity")
+            self.temperature = data.get("temperature")
+        else:
+            (self.loras, self.sensors, self.outputs)[section - 1][slot].load(data)
+
+    def history(self, uid, resolution=0, since=None):
+        # readings of a wireless sensor, raw samples or the rollups of history.ROLLUPS
+        slot = self.lora_index.get(uid_key(uid))
+        if slot == None:
+            return None
+        return self.histories[slot].query(resolution, since)
 
     def add_lora(self, name, uid):
-        if uid != self.lora1.uid or uid != self.lora2.uid or uid != self.lora3.uid or uid != self.lora4.uid:
-            if self.lora1.uid == None:
-                self.lora1.name = name
-                self.lora1.uid = uid
-            elif self.lora2.uid == None:
-                self.lora2.name = name
-                self.lora2.uid = uid
-            elif self.lora3.uid == None:
-                self.lora3.name = name
-                self.lora3.uid = uid
-            elif self.lora4.uid == None:
-                self.lora4.name = name
-                self.lora4.uid = uid
-            self.convert_to_pkg()
+        key = uid_key(uid)
+        if key != None and key not in self.lora_index:
+            for slot, lora in enumerate(self.loras):
+                if lora.uid == None:
+                    lora.name = name
+                    lora.uid = uid
+                    self.lora_index[key] = slot
+                    self.histories[slot].clear()
+                    self.touch(SECTION_LORAS, lora, True)
+                    break
         self.req = True
 
     def delete_lora(self, uid):
-        if uid == self.lora1.uid:
-            self.lora1 = LoraPkg()
-        elif uid == self.lora2.uid:
-            self.lora2 = LoraPkg()
-        elif uid == self.lora3.uid:
-            self.lora3 = LoraPkg()
-        elif uid == self.lora4.uid:
-            self.lora4 = LoraPkg()
-        self.convert_to_pkg()
+        slot = self.lora_index.pop(uid_key(uid), None)
+        if slot != None:
+            self.loras[slot].clear()
+            self.histories[slot].clear()
+            self.touch(SECTION_LORAS, critical=True)
         self.req = True
 
     def update(self, data):
         temp = data.get("wirelessSensors")
         if temp != None:
             for each in temp:
-                uid = each.get("uid")
-                if uid == self.lora1.uid:
-                    self.lora1.name = each.get("name")
-                elif uid == self.lora2.uid:
-                    self.lora2.name = each.get("name")
-                elif uid == self.lora3.uid:
-                    self.lora3.name = each.get("name")
-                elif uid == self.lora4.uid:
-                    self.lora4.name = each.get("name")
-                    
+                lora = self.find_lora(each.get("uid"))
+                if lora != None:
+                    lora.name = each.get("name")
+                    self.touch(SECTION_LORAS, lora, True)
+
         temp = data.get("outputs")
         already_added = []
         if temp != None:
             for each in temp:
-                id = each.get("id")
+                output = self.find_output(each.get("id"))
+                if output == None:
+                    continue
                 uuid = each.get("uuidWirelessSensor")
-                if id == self.output1.id:
-                    self.output1.name = each.get("name")
-                    self.output1.value = each.get("value")
-                    if self.output1.uuidWirelessSensor != uuid and uuid not in already_added:
-                        self.output1.uuidWirelessSensor = uuid
-                        already_added.append(uuid)
-                        if self.output2.uuidWirelessSensor == uuid:
-                            self.output2.uuidWirelessSensor = None
-                        if self.output3.uuidWirelessSensor == uuid:
-                            self.output3.uuidWirelessSensor = None
-                        if self.output4.uuidWirelessSensor == uuid:
-                            self.output4.uuidWirelessSensor = None
-                    self.output1.schedule = each.get("schedule")
-                elif id == self.output2.id:
-                    self.output2.name = each.get("name")
-                    self.output2.value = each.get("value")
-                    if self.output2.uuidWirelessSensor != uuid and uuid not in already_added:
-                        self.output2.uuidWirelessSensor = uuid
-                        already_added.append(uuid)
-                        if self.output1.uuidWirelessSensor == uuid:
-                            self.output1.uuidWirelessSensor = None
-                        if self.output3.uuidWirelessSensor == uuid:
-                            self.output3.uuidWirelessSensor = None
-                        if self.output4.uuidWirelessSensor == uuid:
-                            self.output4.uuidWirelessSensor = None
-                    self.output2.schedule = each.get("schedule")
-                elif id == self.output3.id:
-                    self.output3.name = each.get("name")
-                    self.output3.value = each.get("value")
-                    if self.output3.uuidWirelessSensor != uuid and uuid not in already_added:
-                        self.output3.uuidWirelessSensor = uuid
-                        already_added.append(uuid)
-                        if self.output1.uuidWirelessSensor == uuid:
-                            self.output1.uuidWirelessSensor = None
-                        if self.output2.uuidWirelessSensor == uuid:
-                            self.output2.uuidWirelessSensor = None
-                        if self.output4.uuidWirelessSensor == uuid:
-                            self.output4.uuidWirelessSensor = None
-                    self.output3.schedule = each.get("schedule")
-                elif id == self.output4.id:
-                    self.output4.name = each.get("name")
-                    self.output4.value = each.get("value")
-                    if self.output4.uuidWirelessSensor != uuid and uuid not in already_added:
-                        self.output4.uuidWirelessSensor = uuid
-                        already_added.append(uuid)
-                        if self.output1.uuidWirelessSensor == uuid:
-                            self.output1.uuidWirelessSensor = None
-                        if self.output2.uuidWirelessSensor == uuid:
-                            self.output2.uuidWirelessSensor = None
-                        if self.output3.uuidWirelessSensor == uuid:
-                            self.output3.uuidWirelessSensor = None
-                    self.output4.schedule = each.get("schedule")
-        self.convert_to_pkg()
+                output.name = each.get("name")
+                output.value = each.get("value")
+                if output.uuidWirelessSensor != uuid and uuid not in already_added:
+                    already_added.append(uuid)
+                    self.bind_output(output, uuid)
+                self.schedule_output(output, each.get("schedule"))
+        self.drive_outputs()
+        self.replan()
+        self.req = True
+
+    def bind_output(self, output, uuid):
+        output.bind(uuid)
+        output.filter.reset()
+        # a wireless sensor drives a single output
+        for other in self.outputs:
+            if other is not output and other.uuidWirelessSensor == uuid:
+                other.bind(None)
+                other.filter.reset()
+                self.touch(SECTION_OUTPUTS, other, True)
+        self.touch(SECTION_OUTPUTS, output, True)
+
+    def schedule_output(self, output, schedule):
+        output.set_schedule(schedule)
+        if output.calendar != None:
+            # the current window is taken from the new calendar
+            output.schedule["startTs"] = None
+            output.schedule["endTs"] = None
+        self.touch(SECTION_OUTPUTS, output, True)
+
+    def check_batch(self, ops):
+        # the operations are checked against the state they will find, in order
+        uids = set(self.lora_index)
+        free = len([lora for lora in self.loras if lora.uid == None])
+        for i, op in enumerate(ops):
+            kind = op.get("op")
+            error = None
+            if kind in ("add", "remove", "rename"):
+                key = uid_key(op.get("uid"))
+                if key == None:
+                    error = 'bad uid'
+                elif kind == "add":
+                    if key in uids:
+                        error = 'uid exists'
+                    elif free == 0:
+                        error = 'no free channel'
+                    else:
+                        uids.add(key)
+                        free -= 1
+                elif key not in uids:
+                    error = 'unknown uid'
+                elif kind == "remove":
+                    uids.remove(key)
+                    free += 1
+            elif kind in ("bind", "schedule"):
+                if self.find_output(op.get("id")) == None:
+                    error = 'unknown output'
+                elif kind == "bind" and op.get("uid") != None and uid_key(op.get("uid")) not in uids:
+                    error = 'unknown uid'
+            else:
+                error = 'unknown op'
+            if error != None:
+                raise ValueError('op %d: %s' % (i, error))
+
+    def batch(self, ops):
+        # all operations or none: nothing is applied when one of them fails the check, the state is
+        # restored from its journal records and the histories from their marks when applying fails
+        self.check_batch(ops)
+        saved = list(self.journal_records())
+        histories = [history.mark() for history in self.histories]
+        try:
+            for op in ops:
+                kind = op["op"]
+                if kind == "add":
+                    self.add_lora(op.get("name"), op["uid"])
+                elif kind == "remove":
+                    self.delete_lora(op["uid"])
+                elif kind == "rename":
+                    lora = self.find_lora(op["uid"])
+                    lora.name = op.get("name")
+                    self.touch(SECTION_LORAS, lora, True)
+                elif kind == "bind":
+                    self.bind_output(self.find_output(op["id"]), op.get("uid"))
+                else:
+                    self.schedule_output(self.find_output(op["id"]), op.get("schedule"))
+        except Exception:
+            for section, slot, record in saved:
+                self.apply_record(section, slot, ujson.loads(record))
+            for history, state in zip(self.histories, histories):
+                history.restore(state)
+            self.reindex_loras()
+            self.seed_filters()
+            self.touch_all()
+            raise
+        self.drive_outputs()
+        self.replan()
         self.req = True
 
+    def section_json(self, section):
+        cached = self.sections[section]
+        if cached == None:
+            if section == SECTION_DEVICE:
+                cached = '"rssi": %s, "humidity": %s, "temperature": %s' % (
+                    ujson.dumps(self.rssi), ujson.dumps(self.humidity), ujson.dumps(self.temperature))
+            elif section == SECTION_LORAS:
+                cached = '[' + ', '.join([lora.json() for lora in self.loras if lora.uid != None]) + ']'
+            elif section == SECTION_SENSORS:
+                cached = '[' + ', '.join([sensor.json() for sensor in self.sensors if sensor.type != None]) + ']'
+            else:
+                cached = '[' + ', '.join([output.json() for output in self.outputs if output.name != None]) + ']'
+            self.sections[section] = cached
+        return cached
+
     def convert_to_pkg(self):
-        jsonpkg = {}
-        jsonpkg["rssi"] = self.rssi
-        jsonpkg["humidity"] = self.humidity
-        jsonpkg["temperature"] = self.temperature
-
-        loras = []
-        if self.lora1.uid != None:
-            lora1 = {"rssi": self.lora1.rssi, "name": self.lora1.name, "lastTs": self.lora1.lastTs,
-                     "uid": self.lora1.uid, "batteryLevel": self.lora1.batteryLevel, "humidity": self.lora1.humidity}
-            loras.append(lora1)
-        if self.lora2.uid != None:
-            lora2 = {"rssi": self.lora2.rssi, "name": self.lora2.name, "lastTs": self.lora2.lastTs,
-                     "uid": self.lora2.uid, "batteryLevel": self.lora2.batteryLevel, "humidity": self.lora2.humidity}
-            loras.append(lora2)
-        if self.lora3.uid != None:
-            lora3 = {"rssi": self.lora3.rssi, "name": self.lora3.name, "lastTs": self.lora3.lastTs,
-                     "uid": self.lora3.uid, "batteryLevel": self.lora3.batteryLevel, "humidity": self.lora3.humidity}
-            loras.append(lora3)
-        if self.lora4.uid != None:
-            lora4 = {"rssi": self.lora4.rssi, "name": self.lora4.name, "lastTs": self.lora4.lastTs,
-                     "uid": self.lora4.uid, "batteryLevel": self.lora4.batteryLevel, "humidity": self.lora4.humidity}
-            loras.append(lora4)
-        jsonpkg["wirelessSensors"] = loras
-
-        sensors = []
-        if self.sensor1.type != None:
-            sensor1 = {"type": self.sensor1.type, "uuid": self.sensor1.uuid, "value": self.sensor1.value,
-                       "lastTs": self.sensor1.lastTs}
-            sensors.append(sensor1)
-        if self.sensor2.type != None:
-            sensor2 = {"type": self.sensor2.type, "uuid": self.sensor2.uuid, "value": self.sensor2.value,
-                       "lastTs": self.sensor2.lastTs}
-            sensors.append(sensor2)
-        if self.sensor3.type != None:
-            sensor3 = {"type": self.sensor3.type, "uuid": self.sensor3.uuid, "value": self.sensor3.value,
-                       "lastTs": self.sensor3.lastTs}
-            sensors.append(sensor3)
-        if self.sensor4.type != None:
-            sensor4 = {"type": self.sensor4.type, "uuid": self.sensor4.uuid, "value": self.sensor4.value,
-                       "lastTs": self.sensor4.lastTs}
-            sensors.append(sensor4)
-        jsonpkg["sensors"] = sensors
-
-        outputs = []
-        if self.output1.name != None:
-            output1 = {"name": self.output1.name, "value": self.output1.value, "lastTs": self.output1.lastTs,
-                       "id": self.output1.id,
-                       "uuidWirelessSensor": self.output1.uuidWirelessSensor, "schedule": self.output1.schedule}
-            outputs.append(output1)
-        if self.output2.name != None:
-            output2 = {"name": self.output2.name, "value": self.output2.value, "lastTs": self.output2.lastTs,
-                       "id": self.output2.id,
-                       "uuidWirelessSensor": self.output2.uuidWirelessSensor, "schedule": self.output2.schedule}
-            outputs.append(output2)
-        if self.output3.name != None:
-            output3 = {"name": self.output3.name, "value": self.output3.value, "lastTs": self.output3.lastTs,
-                       "id": self.output3.id,
-                       "uuidWirelessSensor": self.output3.uuidWirelessSensor, "schedule": self.output3.schedule}
-            outputs.append(output3)
-        if self.output4.name != None:
-            output4 = {"name": self.output4.name, "value": self.output4.value, "lastTs": self.output4.lastTs,
-                       "id": self.output4.id,
-                       "uuidWirelessSensor": self.output4.uuidWirelessSensor, "schedule": self.output4.schedule}
-            outputs.append(output4)
-        jsonpkg["outputs"] = outputs
-        self.save_to_file(jsonpkg)
-        return (ujson.dumps(jsonpkg))
-
-    def save_to_file(self, data):
-        with open("data.json", "w", encoding='utf-8') as f:
-            ujson.dump(data, f)
-
-    def check_outputs_val(self):
-        if self.output1.ontime == False:
-            if self.output1.value == True:
-                self.output1.out(1)
-            elif self.output1.value == False:
-                self.output1.out(0)
-
-        if self.output2.ontime == False:
-            if self.output2.value == True:
-                self.output2.out(1)
-            elif self.output2.value == False:
-                self.output2.out(0)
-
-        if self.output3.ontime == False:
-            if self.output3.value == True:
-                self.output3.out(1)
-            elif self.output3.value == False:
-                self.output3.out(0)
-
-        if self.output4.ontime == False:
-            if self.output4.value == True:
-                self.output4.out(1)
-            elif self.output4.value == False:
-                self.output4.out(0)
-
-    def hum_out_math(self, uuid, start, end):
-        if uuid != None:
-            if uuid == self.lora1.uid:
-                hum = self.lora1.humidity
-            elif uuid == self.lora2.uid:
-                hum = self.lora2.humidity
-            elif uuid == self.lora3.uid:
-                hum = self.lora3.humidity
-            elif uuid == self.lora4.uid:
-                hum = self.lora4.humidity
-        else:
+        # Only dirty records and sections are serialized again, an unchanged state returns the cached bytes
+        if self.pkg == None:
+            self.pkg = ('{%s, "wirelessSensors": %s, "sensors": %s, "outputs": %s}' % (
+                self.section_json(SECTION_DEVICE), self.section_json(SECTION_LORAS),
+                self.section_json(SECTION_SENSORS), self.section_json(SECTION_OUTPUTS))).encode()
+        return self.pkg
+
+    def drive_outputs(self):
+        # a running schedule switches the output on, otherwise the manual value decides
+        if self.driver == None:
+            return
+        state = 0
+        for slot, output in enumerate(self.outputs):
+            if output.ontime == True or output.value == True:
+                state |= 1 << slot
+        self.driver.write(state)
+
+    def hum_out_math(self, output, start, end):
+        # the window is shortened by the filtered humidity of the bound sensor, see filters.py.
+        # A filter reset by a new binding or new settings falls back to the recent readings of the sensor.
+        now = self.now()
+        humidity = output.filter.value(now)
+        if humidity == None and now != None:
+            slot = self.lora_index.get(output.sensor)
+            if slot != None:
+                humidity = self.histories[slot].mean(now - output.filter.max_age)
+        if humidity == None:
             return end
-        if hum != None:
-            endts = int(((end - start) * (hum * (-0.01) + 1)) + start)
-            return endts
-        else:
-            return end
-
+        return int(((end - start) * (humidity * (-0.01) + 1)) + start)
+
+    def seed_filters(self):
+        # the persisted last reading of each bound sensor, until new packets arrive
+        for output in self.outputs:
+            output.filter.reset()
+            lora = self.find_lora(output.uuidWirelessSensor)
+            if lora != None:
+                output.filter.add(lora.lastTs, lora.humidity)
+
+    def replan(self):
+        if self.scheduler != None:
+            self.scheduler.replan()
+
+    def output_transition(self, output, now):
+        # next instant at which check_output switches this output, None when nothing is planned
+        if output.ontime == True:
+            # a running output stops at hum_endTs whatever its schedule became meanwhile
+            return output.hum_endTs + 1 if output.hum_endTs != None else now
+        schedule = output.schedule
+        if schedule == None:
+            return None
+        start = schedule.get("startTs")
+        end = schedule.get("endTs")
+        if output.waiting != None:
+            # replanned when a running output stops
+            return now if self.can_start(output, now) else None
+        if output.calendar != None and (end == None or now == None or now > end):
+            if now == None:
+                return None
+            return now if output.calendar.active(now) else output.calendar.next_start(now)
+        if start == None or end == None:
+            return None
+        if now == None or now < start:
+            return start
+        if now <= end:
+            return now
+        return None
+
+    def check_output(self, output):
+        now = self.now()
+        if now == None:
+            return
+        if output.ontime == True:
+            # checked before the schedule: a new calendar or a null schedule clears the window
+            # of a running output, which must still stop
+            if output.hum_endTs == None or now > output.hum_endTs:
+                self.stop_output(output, now)
+            return
+        schedule = output.schedule
+        if schedule == None:
+            return
+        if output.calendar != None and output.waiting == None and \
+                (schedule.get("endTs") == None or now > schedule["endTs"]):
+            self.calendar_window(output, now)
+        start = schedule.get("startTs")
+        end = schedule.get("endTs")
+        if start == None or end == None:
+            return
+        if output.waiting != None or (now >= start and now <= end):
+            if not self.can_start(output, now):
+                if output.waiting == None:
+                    output.waiting = now
+                return
+            # the time spent waiting for the budget is added to the run, even past the window end
+            output.deferred = now - output.waiting if output.waiting != None else 0
+            waited = output.waiting != None
+            output.waiting = None
+            output.hum_endTs = self.hum_out_math(output, start, end) + output.deferred
+            output.lastTs = now
+            output.ontime = True
+            self.drive_outputs()
+            self.touch(SECTION_OUTPUTS, output)
+            if waited:
+                self.wake_waiting()
+
+    def stop_output(self, output, now):
+        output.ontime = False
+        self.drive_outputs()
+        self.wake_waiting()
+        schedule = output.schedule
+        if output.calendar != None:
+            # the rest of this window is skipped, the next run is the following window
+            self.calendar_window(output, output.calendar.next_start(now))
+        elif schedule != None and schedule.get("startTs") != None and schedule.get("endTs") != None:
+            schedule["startTs"] += 86400
+            schedule["endTs"] += 86400
+        self.touch(SECTION_OUTPUTS, output, True)
+
+    def can_start(self, output, now):
+        # within the site budget, and no output deferred before this one is still waiting.
+        # Outputs switched on by hand (value true) take their share of the budget too.
+        running = 0
+        budget = self.flow_budget
+        flow = output.flow
+        order = (output.waiting if output.waiting != None else now, self.outputs.index(output))
+        for slot, other in enumerate(self.outputs):
+            if other is output:
+                continue
+            if other.ontime == True or other.value == True:
+                running += 1
+                if budget != None:
+                    flow += other.flow
+            elif other.waiting != None and (other.waiting, slot) < order:
+                return False
+        if self.max_active != None and running >= self.max_active:
+            return False
+        # an output above the whole budget still runs alone
+        if budget != None and flow > budget and running:
+            return False
+        return True
+
+    def wake_waiting(self):
+        # the next waiting output may fit now
+        for output in self.outputs:
+            if output.waiting != None:
+                self.replan()
+                return
+
+    def calendar_window(self, output, ts):
+        # startTs/endTs of a calendar schedule become the window running at ts, else the next one
+        calendar = output.calendar
+        start = None
+        end = None
+        if ts != None:
+            start = ts if calendar.active(ts) else calendar.next_start(ts)
+        if start != None:
+            end = calendar.next_change(start)
+            if end == None:
+                # always on from here, one run a day
+                end = start + 86400
+        output.schedule["startTs"] = start
+        output.schedule["endTs"] = end
 
     def check_outputs_sch(self):
-        if self.lastTs != None:
-            if self.output1.schedule.get("startTs") != None and self.output1.schedule.get("endTs") != None:
-                if self.lastTs >= self.output1.schedule.get("startTs") and self.lastTs <= self.output1.schedule.get(
-                        "endTs") and self.output1.ontime == False:
-                    self.output1.hum_endTs = self.hum_out_math(self.output1.uuidWirelessSensor,
-                                                                self.output1.schedule.get("startTs"), self.output1.schedule.get("endTs"))
-                    self.output1.lastTs = self.lastTs
-                    self.output1.out(1)
-                    self.output1.ontime = True
-                elif self.output1.hum_endTs != None and self.lastTs > self.output1.hum_endTs and self.output1.ontime == True:
-                    self.output1.out(0)
-                    self.output1.ontime = False
-                    self.output1.schedule["startTs"] = self.output1.schedule.get("startTs") + 86400
-                    self.output1.schedule["endTs"] = self.output1.schedule.get("endTs") + 86400
-                    self.convert_to_pkg()
-
-            if self.output2.schedule.get("startTs") != None and self.output2.schedule.get("endTs") != None:
-                if self.lastTs >= self.output2.schedule.get("startTs") and self.lastTs <= self.output2.schedule.get(
-                        "endTs"):
-                    self.output2.hum_endTs = self.hum_out_math(self.output2.uuidWirelessSensor,
-                                                                self.output2.schedule.get("startTs"), self.output2.schedule.get("endTs"))
-                    self.output2.lastTs = self.lastTs
-                    self.output2.out(1)
-                    self.output2.ontime = True
-                elif self.output2.hum_endTs != None and self.lastTs > self.output2.hum_endTs and self.output2.ontime == True:
-                    self.output2.out(0)
-                    self.output2.ontime = False
-                    self.output2.schedule["startTs"] = self.output2.schedule.get("startTs") + 86400
-                    self.output2.schedule["endTs"] = self.output2.schedule.get("endTs") + 86400
-                    self.convert_to_pkg()
-
-            if self.output3.schedule.get("startTs") != None and self.output3.schedule.get("endTs") != None:
-                if self.lastTs >= self.output3.schedule.get("startTs") and self.lastTs <= self.output3.schedule.get(
-                        "endTs"):
-                    self.output3.hum_endTs = self.hum_out_math(self.output3.uuidWirelessSensor,
-                                                                self.output3.schedule.get("startTs"), self.output3.schedule.get("endTs"))
-                    self.output3.lastTs = self.lastTs
-                    self.output3.out(1)
-                    self.output3.ontime = True
-                elif self.output3.hum_endTs != None and self.lastTs > self.output3.hum_endTs and self.output3.ontime == True:
-                    self.output3.out(0)
-                    self.output3.ontime = False
-                    self.output3.schedule["startTs"] = self.output3.schedule.get("startTs") + 86400
-                    self.output3.schedule["endTs"] = self.output3.schedule.get("endTs") + 86400
-                    self.convert_to_pkg()
-
-            if self.output3.schedule.get("startTs") != None and self.output4.schedule.get("endTs") != None:
-                if self.lastTs >= self.output4.schedule.get("startTs") and self.lastTs <= self.output4.schedule.get(
-                        "endTs"):
-                    self.output4.hum_endTs = self.hum_out_math(self.output4.uuidWirelessSensor,
-                                                                self.output4.schedule.get("startTs"), self.output4.schedule.get("endTs"))
-                    self.output4.lastTs = self.lastTs
-                    self.output4.out(1)
-                    self.output4.ontime = True
-                elif self.output4.hum_endTs != None and self.lastTs > self.output4.hum_endTs and self.output4.ontime == True:
-                    self.output4.out(0)
-                    self.output4.ontime = False
-                    self.output4.schedule["startTs"] = self.output4.schedule.get("startTs") + 86400
-                    self.output4.schedule["endTs"] = self.output4.schedule.get("endTs") + 86400
-                    self.convert_to_pkg()
+        for output in self.outputs:
+            self.check_output(output)
@@ -0,0 +1,103 @@
+import time
+import uasyncio as asyncio
+
+from array import array
+from micropython import const
+
+# Packets read by the LoRa rx task until MasterDevice consumes them, in slots allocated once:
+#   ticks    ticks_us of the DIO1 interrupt
+#   rssi     packet RSSI in dBm, signal the RSSI of the LoRa signal after despreading, in dBm
+#   snr      in quarter dB
+#   status   the radio interrupt bits of the packet, see IRQ_*
+#   data     the first PACKET_MAX payload bytes, length of them in length
+# When the consumer falls behind, the oldest packet gives way and is counted in dropped.
+
+QUEUE_SIZE = const(8)
+PACKET_MAX = const(16)
+# uid (4 bytes), humidity, battery level
+SENSOR_PACKET = const(6)
+
+IRQ_RX_DONE = const(0x0002)
+IRQ_HEADER_ERR = const(0x0020)
+IRQ_CRC_ERR = const(0x0040)
+
+
+class RxQueue:
+    def __init__(self, size=QUEUE_SIZE):
+        self.size = size
+        self.ticks = array('l', [0] * size)
+        self.rssi = array('h', [0] * size)
+        self.snr = array('h', [0] * size)
+        self.signal = array('h', [0] * size)
+        self.status = array('H', [0] * size)
+        self.length = bytearray(size)
+        self.data = bytearray(size * PACKET_MAX)
+        # oldest packet and number of packets queued
+        self.head = 0
+        self.count = 0
+        self.event = asyncio.Event()
+
+        self.pushed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.high = 0
+        self.popped = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def push(self, ticks, buf, offset, length, rssi, snr, signal, status):
+        # copies buf[offset:offset + length], nothing is allocated
+        if self.count == self.size:
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+            self.dropped += 1
+        slot = (self.head + self.count) % self.size
+        length = min(length, PACKET_MAX)
+        base = slot * PACKET_MAX
+        data = self.data
+        for i in range(length):
+            data[base + i] = buf[offset + i]
+        self.length[slot] = length
+        self.ticks[slot] = ticks
+        self.rssi[slot] = rssi
+        self.snr[slot] = snr
+        self.signal[slot] = signal
+        self.status[slot] = status
+        self.count += 1
+        self.pushed += 1
+        if self.count > self.high:
+            self.high = self.count
+        self.event.set()
+
+    def pop(self):
+        # slot of the oldest packet or -1, read it before awaiting: a push may reuse it
+        if self.count == 0:
+            return -1
+        slot = self.head
+        self.head = (slot + 1) % self.size
+        self.count -= 1
+        elapsed = time.ticks_diff(time.ticks_us(), self.ticks[slot])
+        self.popped += 1
+        self.total_us += elapsed
+        if elapsed > self.max_us:
+            self.max_us = elapsed
+        return slot
+
+    async def wait(self):
+        await self.event.wait()
+        self.event.clear()
+
+    def sensor(self, slot):
+        # (uid, humidity, battery) of a sensor packet, None for a corrupt or short one
+        if self.status[slot] & (IRQ_HEADER_ERR | IRQ_CRC_ERR) or self.length[slot] < SENSOR_PACKET:
+            self.errors += 1
+            return None
+        data = self.data
+        base = slot * PACKET_MAX
+        uid = data[base] << 24 | data[base + 1] << 16 | data[base + 2] << 8 | data[base + 3]
+        return uid, data[base + 4], data[base + 5]
+
+    def stats(self):
+        return {"pushed": self.pushed, "dropped": self.dropped, "errors": self.errors, "queued": self.count,
+                "high": self.high, "meanUs": self.total_us // self.popped if self.popped else None,
+                "maxUs": self.max_us}
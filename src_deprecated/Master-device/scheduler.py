@@ -0,0 +1,78 @@
+import uasyncio as asyncio
+
+from uheapq import heappush, heappop
+
+
+class Scheduler:
+    # Keeps the next start/stop instant of every output in a min-heap and sleeps until the
+    # earliest one on the interpolated clock. MasterDevice.replan() rebuilds the heap after a
+    # schedule or humidity change, or when a time broadcast makes the clock jump.
+    def __init__(self, master):
+        self.master = master
+        master.scheduler = self
+        self.heap = []
+        self._event = asyncio.Event()
+        self._dirty = True
+
+        self.wakeups = 0
+        self.transitions = 0
+
+    def replan(self):
+        self._dirty = True
+        self._event.set()
+
+    def plan(self):
+        now = self.master.now()
+        heap = []
+        for slot, output in enumerate(self.master.outputs):
+            ts = self.master.output_transition(output, now)
+            if ts != None:
+                heappush(heap, (ts, slot))
+        self.heap = heap
+        self._dirty = False
+
+    def fire(self):
+        now = self.master.now()
+        outputs = self.master.outputs
+        # bounded: every output can start and stop once per pass
+        for _ in range(2 * len(outputs)):
+            if not self.heap or now == None or self.heap[0][0] > now:
+                return
+            due, slot = heappop(self.heap)
+            output = outputs[slot]
+            self.master.check_output(output)
+            self.transitions += 1
+            if self._dirty:
+                return
+            # an instant not later than the one just handled means check_output had nothing to do,
+            # the output waits for the next replan() instead of waking the loop again
+            ts = self.master.output_transition(output, now)
+            if ts != None and ts > due:
+                heappush(self.heap, (ts, slot))
+
+    def delay(self):
+        now_ms = self.master.clock.now_ms()
+        if not self.heap or now_ms == None:
+            return None
+        return max(self.heap[0][0] * 1000 - now_ms, 0) / 1000
+
+    async def run(self):
+        while True:
+            if self._dirty:
+                self.plan()
+            self.fire()
+            if self._dirty:
+                continue
+            delay = self.delay()
+            self._event.clear()
+            try:
+                if delay == None:
+                    await self._event.wait()
+                else:
+                    await asyncio.wait_for(self._event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeups += 1
+
+    def stats(self):
+        return {"wakeups": self.wakeups, "transitions": self.transitions, "planned": len(self.heap)}
@@ -0,0 +1,242 @@
+import ujson
+
+from micropython import const
+from ustruct import pack_into, unpack_from
+
+# Binary snapshot of the MasterDevice state, the JSON document stays the export format.
+#
+#   header   b'WSN' <version u8> <loras u8> <sensors u8> <outputs u8>
+#   device   record of the rssi, humidity, temperature cells
+#   loras    fixed-size records, then sensors, then outputs
+#   extras   JSON blobs of the values that do not fit their record
+#
+# Every record starts with a used flag and the <offset u16><length u16> of its extras blob, counted
+# from the end of the records, length 0 when it has none. Unused channels are skipped without decoding.
+# A cell is <tag u8><8 bytes>: None, int (q), float (d), False, True or in the extras.
+# A string is <length u8, 0xFF for None, 0xFE when in the extras> + fixed room.
+# The schedule of an output keeps startTs/endTs in cells, its other fields ("windows", "filter",
+# "flow", ...) go to the extras under "schedule".
+
+MAGIC = b'WSN'
+VERSION = const(2)
+
+_HEADER = '<3sBBBB'
+_HEADER_SIZE = const(7)
+_RECORD_HEAD = '<BHH'
+_RECORD_HEAD_SIZE = const(5)
+_CELL_SIZE = const(9)
+_NONE = const(0)
+_INT = const(1)
+_FLOAT = const(2)
+_FALSE = const(3)
+_TRUE = const(4)
+_EXTRA = const(5)
+_STR_NONE = const(0xFF)
+_STR_EXTRA = const(0xFE)
+
+# room of the extras blobs per output channel, a snapshot that needs more is written as JSON
+EXTRAS_ROOM = const(256)
+
+# (field, string room) - room 0 is a cell
+DEVICE_FIELDS = (('rssi', 0), ('humidity', 0), ('temperature', 0))
+LORA_FIELDS = (('name', 24), ('uid', 12), ('rssi', 0), ('lastTs', 0), ('batteryLevel', 0), ('humidity', 0))
+SENSOR_FIELDS = (('type', 16), ('uuid', 36), ('value', 0), ('lastTs', 0))
+OUTPUT_FIELDS = (('name', 24), ('id', 0), ('uuidWirelessSensor', 12), ('value', 0), ('lastTs', 0),
+                 ('startTs', 0), ('endTs', 0))
+
+
+def _fields_size(fields):
+    size = _RECORD_HEAD_SIZE
+    for _, room in fields:
+        size += room + 1 if room else _CELL_SIZE
+    return size
+
+
+_DEVICE_SIZE = _fields_size(DEVICE_FIELDS)
+_LORA_SIZE = _fields_size(LORA_FIELDS)
+_SENSOR_SIZE = _fields_size(SENSOR_FIELDS)
+_OUTPUT_SIZE = _fields_size(OUTPUT_FIELDS)
+
+
+def size(loras, sensors, outputs):
+    # the records, the extras follow
+    return _HEADER_SIZE + _DEVICE_SIZE + loras * _LORA_SIZE + sensors * _SENSOR_SIZE + outputs * _OUTPUT_SIZE
+
+
+def is_snapshot(buf):
+    return len(buf) >= _HEADER_SIZE and bytes(buf[:3]) == MAGIC
+
+
+def _put(buf, pos, value, room):
+    # False when the value does not fit the field, it is marked to be read from the extras
+    if room:
+        if value == None:
+            buf[pos] = _STR_NONE
+            return True
+        data = value.encode() if isinstance(value, str) else None
+        if data == None or len(data) > room:
+            buf[pos] = _STR_EXTRA
+            return False
+        buf[pos] = len(data)
+        buf[pos + 1:pos + 1 + len(data)] = data
+        return True
+    if value == None:
+        pack_into('<Bq', buf, pos, _NONE, 0)
+    elif value is True or value is False:
+        pack_into('<Bq', buf, pos, _TRUE if value else _FALSE, 0)
+    elif isinstance(value, int) and -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+        pack_into('<Bq', buf, pos, _INT, value)
+    elif isinstance(value, float):
+        pack_into('<Bd', buf, pos, _FLOAT, value)
+    else:
+        pack_into('<Bq', buf, pos, _EXTRA, 0)
+        return False
+    return True
+
+
+def _get(buf, pos, room):
+    # None also for a value in the extras
+    if room:
+        length = buf[pos]
+        if length == _STR_NONE or length == _STR_EXTRA:
+            return None
+        return bytes(buf[pos + 1:pos + 1 + length]).decode()
+    tag = buf[pos]
+    if tag == _INT:
+        return unpack_from('<q', buf, pos + 1)[0]
+    if tag == _FLOAT:
+        return unpack_from('<d', buf, pos + 1)[0]
+    if tag == _TRUE:
+        return True
+    if tag == _FALSE:
+        return False
+    return None
+
+
+def _put_fields(buf, pos, fields, data):
+    # writes the fields of data, returns what is left for the extras or None
+    extras = None
+    for name, room in fields:
+        value = data.pop(name)
+        if not _put(buf, pos, value, room):
+            if extras == None:
+                extras = {}
+            extras[name] = value
+        pos += room + 1 if room else _CELL_SIZE
+    if data:
+        if extras == None:
+            extras = {}
+        extras.update(data)
+    return extras
+
+
+def _get_fields(buf, pos, fields):
+    data = {}
+    for name, room in fields:
+        data[name] = _get(buf, pos, room)
+        pos += room + 1 if room else _CELL_SIZE
+    return data
+
+
+def _output_data(output):
+    data = output.to_dict()
+    schedule = data.pop('schedule')
+    if schedule == None:
+        data['startTs'] = None
+        data['endTs'] = None
+        data['schedule'] = None
+        return data
+    # a missing startTs/endTs comes back as None, which reads the same
+    data['startTs'] = schedule.get('startTs')
+    data['endTs'] = schedule.get('endTs')
+    rest = None
+    for key in schedule:
+        if key != 'startTs' and key != 'endTs':
+            if rest == None:
+                rest = {}
+            rest[key] = schedule[key]
+    if rest != None:
+        data['schedule'] = rest
+    return data
+
+
+def _put_record(buf, pos, fields, data, tail, end):
+    # the record at pos and its extras at end, returns the new end of the extras
+    extras = _put_fields(buf, pos + _RECORD_HEAD_SIZE, fields, data)
+    length = 0
+    if extras != None:
+        blob = ujson.dumps(extras).encode()
+        length = len(blob)
+        if end + length > len(buf) or end + length - tail > 0xFFFF:
+            raise ValueError('extras too long')
+        buf[end:end + length] = blob
+    pack_into(_RECORD_HEAD, buf, pos, 1, end - tail, length)
+    return end + length
+
+
+def encode(master, buf):
+    # writes the state into the preallocated buf, ValueError when the extras do not fit in it
+    pack_into(_HEADER, buf, 0, MAGIC, VERSION, len(master.loras), len(master.sensors), len(master.outputs))
+    tail = size(len(master.loras), len(master.sensors), len(master.outputs))
+    end = _put_record(buf, _HEADER_SIZE, DEVICE_FIELDS,
+                      {'rssi': master.rssi, 'humidity': master.humidity, 'temperature': master.temperature}, tail, tail)
+    pos = _HEADER_SIZE + _DEVICE_SIZE
+    for table, fields, used, record_size in ((master.loras, LORA_FIELDS, 'uid', _LORA_SIZE),
+                                             (master.sensors, SENSOR_FIELDS, 'type', _SENSOR_SIZE),
+                                             (master.outputs, OUTPUT_FIELDS, 'name', _OUTPUT_SIZE)):
+        for record in table:
+            if getattr(record, used) == None:
+                pack_into(_RECORD_HEAD, buf, pos, 0, 0, 0)
+            else:
+                data = _output_data(record) if fields is OUTPUT_FIELDS else record.to_dict()
+                end = _put_record(buf, pos, fields, data, tail, end)
+            pos += record_size
+    return end
+
+
+class Snapshot:
+    # read-only view over an encoded snapshot, records are decoded when asked for
+    def __init__(self, buf):
+        magic, version, self.loras, self.sensors, self.outputs = unpack_from(_HEADER, buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('bad snapshot')
+        self.tail = size(self.loras, self.sensors, self.outputs)
+        if len(buf) < self.tail:
+            raise ValueError('short snapshot')
+        self.buf = buf
+
+    def _record(self, pos, fields):
+        used, offset, length = unpack_from(_RECORD_HEAD, self.buf, pos)
+        if used == 0:
+            return None
+        data = _get_fields(self.buf, pos + _RECORD_HEAD_SIZE, fields)
+        if length:
+            start = self.tail + offset
+            if start + length > len(self.buf):
+                raise ValueError('short snapshot')
+            data.update(ujson.loads(bytes(self.buf[start:start + length])))
+        return data
+
+    def device(self):
+        return self._record(_HEADER_SIZE, DEVICE_FIELDS)
+
+    def lora(self, slot):
+        return self._record(_HEADER_SIZE + _DEVICE_SIZE + slot * _LORA_SIZE, LORA_FIELDS)
+
+    def sensor(self, slot):
+        return self._record(_HEADER_SIZE + _DEVICE_SIZE + self.loras * _LORA_SIZE + slot * _SENSOR_SIZE,
+                            SENSOR_FIELDS)
+
+    def output(self, slot):
+        data = self._record(_HEADER_SIZE + _DEVICE_SIZE + self.loras * _LORA_SIZE + self.sensors * _SENSOR_SIZE
+                            + slot * _OUTPUT_SIZE, OUTPUT_FIELDS)
+        if data != None:
+            schedule = {'startTs': data.pop('startTs'), 'endTs': data.pop('endTs')}
+            if 'schedule' in data:
+                rest = data.pop('schedule')
+                if rest == None:
+                    schedule = None
+                else:
+                    schedule.update(rest)
+            data['schedule'] = schedule
+        return data
@@ -0,0 +1,175 @@
+import os
+import uasyncio as asyncio
+
+from micropython import const
+from ubinascii import crc32
+from ustruct import pack, unpack
+
+# Messages published while MQTT is down, kept on flash until they are sent.
+#
+#   spool.<n>    segments of records <topic len u16> <payload len u16> <crc32 u32> topic payload
+#   spool.pos    <segment u32> <offset u32> of the next record to send
+#
+# New records go to the newest segment. When SEGMENTS segments are full the oldest one is
+# dropped. The read position is saved every CURSOR_EVERY messages, so after a reset a few
+# messages may be sent twice but none is lost.
+
+PREFIX = 'spool'
+SEGMENTS = const(4)
+SEGMENT_SIZE = const(8192)
+CURSOR_EVERY = const(8)
+# pause between replayed messages
+DRAIN_MS = const(250)
+
+_HEAD = '<HHI'
+_HEAD_SIZE = const(8)
+
+
+class Spool:
+    def __init__(self, prefix=PREFIX, segments=SEGMENTS, segment_size=SEGMENT_SIZE):
+        self.prefix = prefix
+        self.segments = segments
+        self.segment_size = segment_size
+
+        self.spooled = 0
+        self.dropped = 0
+        self.replayed = 0
+
+        self._unsaved = 0
+        self._recover()
+        # nothing left to send, updated by put() and peek() so senders can check it without flash reads
+        self.empty = self.peek() == None
+
+    def _path(self, segment):
+        return self.prefix + '.' + str(segment)
+
+    def _size(self, segment):
+        try:
+            return os.stat(self._path(segment))[6]
+        except OSError:
+            return 0
+
+    def _recover(self):
+        found = []
+        for name in os.listdir():
+            if name.startswith(self.prefix + '.') and name[len(self.prefix) + 1:].isdigit():
+                found.append(int(name[len(self.prefix) + 1:]))
+        self.first = min(found) if found else 0
+        self.last = max(found) if found else 0
+        self.offset = 0
+        try:
+            with open(self.prefix + '.pos', 'rb') as f:
+                segment, offset = unpack('<II', f.read(8))
+            if segment == self.first:
+                self.offset = offset
+            elif segment > self.first:
+                # the segments before the saved position were sent already
+                for old in range(self.first, min(segment, self.last)):
+                    self._remove(old)
+                self.first = min(segment, self.last)
+                self.offset = offset if segment == self.first else 0
+        except (OSError, ValueError):
+            pass
+        # records after a torn one cannot be reached, new records start a new segment
+        end = 0
+        while True:
+            record = self._read(self.last, end)
+            if record == None:
+                break
+            end = record[2]
+        if end != self._size(self.last):
+            self.last += 1
+
+    def _remove(self, segment):
+        try:
+            os.remove(self._path(segment))
+        except OSError:
+            pass
+
+    def _read(self, segment, offset):
+        # (topic, payload, next offset) or None at the end or at a torn record
+        try:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                head = f.read(_HEAD_SIZE)
+                if len(head) != _HEAD_SIZE:
+                    return None
+                topic_size, payload_size, crc = unpack(_HEAD, head)
+                topic = f.read(topic_size)
+                payload = f.read(payload_size)
+        except OSError:
+            return None
+        if len(topic) != topic_size or len(payload) != payload_size or crc32(payload, crc32(topic)) != crc:
+            return None
+        return topic.decode(), payload, offset + _HEAD_SIZE + topic_size + payload_size
+
+    def _count(self, segment, offset):
+        count = 0
+        record = self._read(segment, offset)
+        while record != None:
+            count += 1
+            record = self._read(segment, record[2])
+        return count
+
+    def put(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        if self._size(self.last) + _HEAD_SIZE + len(topic) + len(payload) > self.segment_size and self._size(self.last):
+            self.last += 1
+            if self.last - self.first >= self.segments:
+                self.dropped += self._count(self.first, self.offset)
+                self._remove(self.first)
+                self.first += 1
+                self.offset = 0
+        with open(self._path(self.last), 'ab') as f:
+            f.write(pack(_HEAD, len(topic), len(payload), crc32(payload, crc32(topic))))
+            f.write(topic)
+            f.write(payload)
+        self.spooled += 1
+        self.empty = False
+
+    def peek(self):
+        # oldest unsent (topic, payload), None when the spool is empty
+        while True:
+            record = self._read(self.first, self.offset)
+            if record != None:
+                return record[0], record[1]
+            if self.first >= self.last:
+                self.empty = True
+                return None
+            self._remove(self.first)
+            self.first += 1
+            self.offset = 0
+
+    def pop(self):
+        record = self._read(self.first, self.offset)
+        if record == None:
+            return
+        self.offset = record[2]
+        self.replayed += 1
+        self._unsaved += 1
+        if self._unsaved >= CURSOR_EVERY:
+            self.save_cursor()
+
+    def save_cursor(self):
+        with open(self.prefix + '.pos', 'wb') as f:
+            f.write(pack('<II', self.first, self.offset))
+        self._unsaved = 0
+
+    async def drain(self, mqtt, pause_ms=DRAIN_MS):
+        # oldest first, one message per pause_ms while connected
+        while True:
+            message = self.peek() if mqtt.is_connected else None
+            if message == None:
+                if self._unsaved:
+                    self.save_cursor()
+                await asyncio.sleep(1)
+                continue
+            mqtt.publish(topic=message[0], payload=message[1], retain=False)
+            self.pop()
+            await asyncio.sleep_ms(pause_ms)
+
+    def stats(self):
+        return {"spooled": self.spooled, "dropped": self.dropped, "replayed": self.replayed,
+                "segments": self.last - self.first + 1}
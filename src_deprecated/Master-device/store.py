@@ -0,0 +1,229 @@
+import os
+import time
+import uasyncio as asyncio
+
+from micropython import const
+from ubinascii import crc32
+from ustruct import pack, unpack
+
+STATE_FILE = 'data.bin'
+JOURNAL_FILE = 'data.jnl'
+# JSON state written by older firmware, read once when STATE_FILE does not exist yet
+LEGACY_FILE = 'data.json'
+
+# a burst of commands is merged into one write
+CRITICAL_DELAY_MS = const(1000)
+# sensor readings are written once the radio has been quiet for DEBOUNCE_MS, and at least every MAX_DELAY_MS
+DEBOUNCE_MS = const(30000)
+MAX_DELAY_MS = const(600000)
+WRITE_CHUNK = const(512)
+# the journal is folded into a new snapshot once it grows past this size
+COMPACT_SIZE = const(16384)
+
+# Journal layout: b'JNL1' + crc32 of the snapshot it applies to, then records of
+#   <section u8> <slot u8> <length u16> <crc32 u32> <record json>
+# Every record is the full state of one channel, so replaying a record twice is harmless.
+# Replay stops at the first torn or corrupt record.
+_JOURNAL_MAGIC = b'JNL1'
+_RECORD_HEAD = '<BBHI'
+_RECORD_HEAD_SIZE = const(8)
+
+
+def _rename(src, dst):
+    # littlefs replaces dst atomically, FAT refuses an existing dst
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class StateStore:
+    def __init__(self, path=STATE_FILE, journal=JOURNAL_FILE, legacy=LEGACY_FILE, debounce_ms=DEBOUNCE_MS, max_delay_ms=MAX_DELAY_MS,
+                 critical_delay_ms=CRITICAL_DELAY_MS, compact_size=COMPACT_SIZE):
+        self.path = path
+        self.journal = journal
+        self.legacy = legacy
+        self.debounce_ms = debounce_ms
+        self.max_delay_ms = max_delay_ms
+        self.critical_delay_ms = critical_delay_ms
+        self.compact_size = compact_size
+
+        self.dirty = False
+        self.critical = False
+        self._first_ts = 0
+        self._last_ts = 0
+        self._event = asyncio.Event()
+
+        # (section, slot) -> record json as last written to flash
+        self._written = {}
+        self._journal_size = 0
+        self._compact = False
+
+        self.marks = 0
+        self.writes = 0
+        self.entries = 0
+        self.compactions = 0
+        self.replayed = 0
+
+    @property
+    def writes_avoided(self) -> int:
+        return self.marks - self.writes if self.marks > self.writes else 0
+
+    def mark(self, critical=False):
+        now = time.ticks_ms()
+        if not self.dirty:
+            self.dirty = True
+            self._first_ts = now
+        self._last_ts = now
+        self.critical = self.critical or critical
+        self.marks += 1
+        self._event.set()
+
+#==========================SNAPSHOT==========================
+
+    def load(self, buf=None):
+        # one read into buf when the snapshot fits, else a new bytes object
+        try:
+            path = self.path
+            length = os.stat(path)[6]
+        except OSError:
+            path = self.legacy
+            length = os.stat(path)[6]
+        with open(path, 'rb') as f:
+            if buf != None and length <= len(buf):
+                return memoryview(buf)[:f.readinto(buf)]
+            return f.read()
+
+    def save(self, data: bytes):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        _rename(tmp, self.path)
+        self._new_journal(data)
+        self.writes += 1
+
+    async def save_async(self, data: bytes):
+        # the flash write is split so the MQTT and LoRa tasks run between chunks
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            view = memoryview(data)
+            for i in range(0, len(data), WRITE_CHUNK):
+                f.write(view[i:i + WRITE_CHUNK])
+                await asyncio.sleep_ms(0)
+        _rename(tmp, self.path)
+        self._new_journal(data)
+        self.writes += 1
+
+#==========================JOURNAL==========================
+
+    def _new_journal(self, snapshot: bytes):
+        with open(self.journal, 'wb') as f:
+            f.write(_JOURNAL_MAGIC + pack('<I', crc32(snapshot)))
+        self._journal_size = 8
+        self._compact = False
+
+    def replay(self, snapshot: bytes):
+        # yields (section, slot, record json) journaled on top of this snapshot
+        try:
+            with open(self.journal, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self._compact = True
+            return
+        if data[:8] != _JOURNAL_MAGIC + pack('<I', crc32(snapshot)):
+            self._compact = True
+            return
+        pos = 8
+        end = len(data)
+        view = memoryview(data)
+        while pos + _RECORD_HEAD_SIZE <= end:
+            section, slot, size, crc = unpack(_RECORD_HEAD, view[pos:pos + _RECORD_HEAD_SIZE])
+            body = view[pos + _RECORD_HEAD_SIZE:pos + _RECORD_HEAD_SIZE + size]
+            if len(body) != size or crc32(body, crc32(view[pos:pos + 4])) != crc:
+                break
+            self.replayed += 1
+            yield section, slot, body
+            pos += _RECORD_HEAD_SIZE + size
+        self._journal_size = pos
+        # a torn tail must not stay in front of new records, and a long journal slows the next boot
+        if pos != end or pos > self.compact_size // 2:
+            self._compact = True
+
+    def request_compaction(self):
+        self._compact = True
+
+    def track(self, master):
+        # the current state is what flash holds, only later changes are journaled
+        self._written = {}
+        for section, slot, record in master.journal_records():
+            self._written[(section, slot)] = record
+
+    def _changes(self, master):
+        entries = []
+        for section, slot, record in master.journal_records():
+            key = (section, slot)
+            if self._written.get(key) != record:
+                self._written[key] = record
+                body = record.encode()
+                head = pack('<BBH', section, slot, len(body))
+                entries.append(head + pack('<I', crc32(body, crc32(head))) + body)
+        return entries
+
+    def append(self, master):
+        entries = self._changes(master)
+        if entries:
+            with open(self.journal, 'ab') as f:
+                for entry in entries:
+                    f.write(entry)
+                    self._journal_size += len(entry)
+            self.entries += len(entries)
+            self.writes += 1
+        if self._journal_size > self.compact_size:
+            self._compact = True
+
+#==========================TASK==========================
+
+    def _due_in(self) -> int:
+        now = time.ticks_ms()
+        if self.critical:
+            return self.critical_delay_ms - time.ticks_diff(now, self._last_ts)
+        return min(self.debounce_ms - time.ticks_diff(now, self._last_ts),
+                   self.max_delay_ms - time.ticks_diff(now, self._first_ts))
+
+    async def compact(self, master):
+        snapshot = master.snapshot()
+        self.track(master)
+        await self.save_async(snapshot)
+        self.compactions += 1
+
+    async def run(self, master):
+        if self._compact:
+            await self.compact(master)
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            while self.dirty:
+                due = self._due_in()
+                if due > 0:
+                    await asyncio.sleep_ms(min(due, self.critical_delay_ms))
+                    continue
+                self.dirty = False
+                self.critical = False
+                self.append(master)
+                if self._compact:
+                    await self.compact(master)
+
+    def flush(self, master):
+        if self._compact:
+            self.track(master)
+            self.save(master.snapshot())
+        elif self.dirty:
+            self.append(master)
+        self.dirty = False
+        self.critical = False
+
+    def stats(self):
+        return {"marks": self.marks, "writes": self.writes, "writesAvoided": self.writes_avoided,
+                "journalEntries": self.entries, "journalSize": self._journal_size,
+                "compactions": self.compactions, "replayed": self.replayed}
@@ -0,0 +1,120 @@
+import ujson
+
+from micropython import const
+from pkg import SECTION_DEVICE, SECTION_LORAS, SECTION_SENSORS, SECTION_OUTPUTS
+
+# Delta telemetry, published to '<uuid>/delta' instead of the full document on '<uuid>':
+#
+#   keyframe: {"seq": 7, "full": <convert_to_pkg() document>}
+#   delta:    {"seq": 9, "base": 7, "set": {"device": {"rssi": 12},
+#                                           "wirelessSensors": {"<uid>": {"humidity": 40, "lastTs": 1700000000}},
+#                                           "outputs": {"<id>": {...}}, "sensors": {"<uuid>": {...}}},
+#                                   "del": {"wirelessSensors": ["<uid>"]}}
+#
+# A delta is always relative to the last snapshot the backend acknowledged (or to the keyframe `base`),
+# never to the previous delta, so lost deltas do not corrupt the rebuilt state. The backend keeps the
+# state for every seq it acknowledges, rebuilds `state[seq] = state[base] + set - del` and acks by
+# publishing the seq to 'FF09/<uuid>/ack'. Records are keyed by uid / uuid / id inside a section,
+# a record new to the base is sent with all its fields.
+
+KEYFRAME_EVERY = const(16)
+PENDING_MAX = const(4)
+
+
+def _snapshot(master):
+    # (section, key) -> cached json fragment of the record, see MasterDevice.section_json
+    state = {(SECTION_DEVICE, None): '{' + master.section_json(SECTION_DEVICE) + '}'}
+    for lora in master.loras:
+        if lora.uid != None:
+            state[(SECTION_LORAS, lora.uid)] = lora.json()
+    for sensor in master.sensors:
+        if sensor.type != None:
+            state[(SECTION_SENSORS, sensor.uuid)] = sensor.json()
+    for output in master.outputs:
+        if output.name != None:
+            state[(SECTION_OUTPUTS, str(output.id))] = output.json()
+    return state
+
+
+class DeltaTelemetry:
+    def __init__(self, master, keyframe_every=KEYFRAME_EVERY, acked=True):
+        self.master = master
+        self.keyframe_every = keyframe_every
+        # without acks every published message is taken as received
+        self.acked = acked
+        self.seq = 0
+        self.base = None
+        self.base_seq = None
+        self.pending = {}
+        self.since_keyframe = 0
+
+        self.keyframes = 0
+        self.deltas = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0
+
+    def diff(self, state):
+        changes = {}
+        deleted = {}
+        base = self.base
+        for key, fragment in state.items():
+            old = base.get(key)
+            if old == fragment:
+                continue
+            fields = ujson.loads(fragment)
+            if old != None:
+                old_fields = ujson.loads(old)
+                for name in list(fields):
+                    if name in old_fields and old_fields[name] == fields[name]:
+                        del fields[name]
+            section, id = key
+            if id == None:
+                changes[section] = fields
+            else:
+                changes.setdefault(section, {})[id] = fields
+        for key in base:
+            if key not in state:
+                deleted.setdefault(key[0], []).append(key[1])
+        return changes, deleted
+
+    def next(self):
+        state = _snapshot(self.master)
+        full = self.master.convert_to_pkg()
+        self.seq += 1
+        if self.base == None or self.since_keyframe >= self.keyframe_every:
+            payload = b'{"seq": ' + str(self.seq).encode() + b', "full": ' + full + b'}'
+            self.since_keyframe = 0
+            self.keyframes += 1
+        else:
+            changes, deleted = self.diff(state)
+            pkg = {"seq": self.seq, "base": self.base_seq, "set": changes}
+            if deleted:
+                pkg["del"] = deleted
+            payload = ujson.dumps(pkg).encode()
+            self.since_keyframe += 1
+            self.deltas += 1
+        self.bytes_sent += len(payload)
+        self.bytes_full += len(full)
+
+        if self.acked:
+            self.pending[self.seq] = state
+            if len(self.pending) > PENDING_MAX:
+                del self.pending[min(self.pending)]
+        else:
+            self.base = state
+            self.base_seq = self.seq
+        return payload
+
+    def ack(self, seq):
+        state = self.pending.get(seq)
+        if state == None:
+            return
+        self.base = state
+        self.base_seq = seq
+        for key in list(self.pending):
+            if key <= seq:
+                del self.pending[key]
+
+    def stats(self):
+        return {"keyframes": self.keyframes, "deltas": self.deltas,
+                "bytesSent": self.bytes_sent, "bytesFull": self.bytes_full}